@@ -11,12 +11,29 @@ import sys
 import argparse
 import stat
 import enum
+import re
+import platform
+import array
+import itertools
+import bisect
+import mmap
+import tempfile
+import threading
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import socket
+import select
 
 
 class ObjectType(enum.Enum):
     commit = 1
     tree = 2
     blob = 3
+    tag = 4
+    ofs_delta = 6
+    ref_delta = 7
 
 
 IndexEntry = collections.namedtuple('IndexEntry', [
@@ -24,6 +41,93 @@ IndexEntry = collections.namedtuple('IndexEntry', [
     'gid', 'size', 'sha1', 'flags', 'path',
 ])
 
+Pathspec = collections.namedtuple('Pathspec', [
+    'path', 'prefix', 'regex', 'dir_only',
+])
+IgnorePattern = collections.namedtuple('IgnorePattern', [
+    'regex', 'negate', 'dir_only', 'anchored', 'base',
+])
+
+UntrackedCache = collections.namedtuple('UntrackedCache', [
+    'ident', 'info_exclude', 'excludes_file', 'dir_flags', 'exclude_per_dir',
+    'root',
+])
+
+CacheTree = collections.namedtuple('CacheTree', [
+    'name', 'entry_count', 'sha1', 'subtrees',
+])
+
+UntrackedDir = collections.namedtuple('UntrackedDir', [
+    'name', 'valid', 'check_only', 'stat_data', 'exclude_oid', 'untracked',
+    'dirs',
+])
+
+Pack = collections.namedtuple('Pack', [
+    'path', 'num_objects', 'fanout', 'index', 'data',
+])
+
+PACK_CHUNK_SIZE = 64 * 1024
+LOOSE_HEADER_SIZE = 64
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_IN_MEMORY_SIZE = 8 * 1024 * 1024
+
+DELTA_WINDOW = 10
+DELTA_DEPTH = 50
+DELTA_WINDOW_MEMORY = 256 * 1024 * 1024
+DELTA_BLOCK_SIZE = 16
+DELTA_MAX_INSERT = 0x7f
+DELTA_MAX_COPY = 0x10000
+# lower than git's 512m default: the delta search here is pure Python
+DELTA_BIG_FILE_THRESHOLD = 4 * 1024 * 1024
+
+DELTA_BASE_CACHE_LIMIT = 96 * 1024 * 1024
+
+PRUNE_GRACE_PERIOD = 14 * 24 * 60 * 60
+
+HEX_DIGITS = frozenset('0123456789abcdef')
+NULL_SHA1 = b'\x00' * 20
+INDEX_EXTENSIONS = [b'link', b'TREE', b'UNTR', b'FSMN']
+INDEX_VERSIONS = (2, 4)
+INDEX_STAT_FIELDS = IndexEntry._fields[:10]
+INDEX_PADDING = [b'\x00' * n for n in range(9)]
+RACY_INTERVAL_NS = 2 * 1000 * 1000 * 1000
+
+SPLIT_INDEX_MAX_PERCENT_CHANGE = 20
+SHARED_INDEX_EXPIRE = 14 * 24 * 60 * 60
+
+FSMONITOR_SOCKET = os.path.join('.git', 'fsmonitor.sock')
+FSMONITOR_TIMEOUT = 5
+FSMONITOR_MAX_CHANGES = 1000000
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONTFOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+FSMONITOR_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+                  IN_ONLYDIR | IN_DONTFOLLOW)
+
+_packs = {}
+_pack_dir_mtime = None
+_loose_object_names = {}
+_loose_object_names_lock = threading.Lock()
+_object_dirs_ready = False
+_delta_base_cache = collections.OrderedDict()
+_delta_base_cache_size = 0
+_shared_index = {}
+_index_cache = None
+
 
 def read_file(path):
 
@@ -37,6 +141,22 @@ def write_file(path, data):
         f.write(data)
 
 
+def write_file_atomic(path, data):
+
+    # other processes see either the old file or the complete new one
+    fd, temp_path = tempfile.mkstemp(prefix='tmp_',
+                                     dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 def init(repo):
 
     try:
@@ -54,71 +174,774 @@ def init(repo):
     print(f"""initialized empty repository: {repo}""")
 
 
+def read_config():
+
+    config = {}
+    config_home = (os.environ.get('XDG_CONFIG_HOME') or
+                   os.path.join(os.path.expanduser('~'), '.config'))
+    paths = [os.path.join(config_home, 'git', 'config'),
+             os.path.join(os.path.expanduser('~'), '.gitconfig'),
+             os.path.join('.git', 'config')]
+    for path in paths:
+        try:
+            lines = read_file(path).decode().splitlines()
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        section = ''
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('['):
+                header = line[1:line.index(']')].strip()
+                name, _, subsection = header.partition(' ')
+                section = name.lower()
+                if subsection:
+                    section += '.' + subsection.strip().strip('"')
+                continue
+            key, has_value, value = line.partition('=')
+            value = value.strip()
+            if len(value) >= 2 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            config[section + '.' + key.strip().lower()] = (
+                value if has_value else 'true')
+    return config
+
+
+def get_config(name, default=None):
+
+    section, _, key = name.rpartition('.')
+    return read_config().get(section.lower() + '.' + key.lower(), default)
+
+
+def get_config_bool(name, default=False):
+
+    value = get_config(name)
+    if value is None:
+        return default
+    return value.lower() in ('true', 'yes', 'on', '1')
+
+
+def get_config_size(name, default=None):
+
+    value = get_config(name)
+    if value is None:
+        return default
+    value = value.strip().lower()
+    scale = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}.get(value[-1:], 1)
+    if scale != 1:
+        value = value[:-1]
+    try:
+        return int(value) * scale
+    except ValueError:
+        raise ValueError(f"""bad size value for {name}: {value!r}""")
+
+
+def ensure_object_dirs():
+
+    global _object_dirs_ready
+    if _object_dirs_ready:
+        return
+    objects_dir = os.path.join('.git', 'objects')
+    existing = set(os.listdir(objects_dir))
+    for i in range(256):
+        bucket = '{:02x}'.format(i)
+        if bucket not in existing:
+            os.makedirs(os.path.join(objects_dir, bucket), exist_ok=True)
+    _object_dirs_ready = True
+
+
+def object_exists(sha1):
+
+    if find_packed_object(sha1) is not None:
+        return True
+    cached = _loose_object_names.get(sha1[:2])
+    names = cached[1] if cached else get_loose_object_names(sha1[:2])
+    i = bisect.bisect_left(names, sha1[2:])
+    return i < len(names) and names[i] == sha1[2:]
+
+
+def remember_loose_object(sha1):
+
+    cached = _loose_object_names.get(sha1[:2])
+    if cached is None:
+        return
+    names = cached[1]
+    with _loose_object_names_lock:
+        i = bisect.bisect_left(names, sha1[2:])
+        if i == len(names) or names[i] != sha1[2:]:
+            names.insert(i, sha1[2:])
+
+
+def open_object_temp():
+
+    fd, temp_path = tempfile.mkstemp(
+        prefix='tmp_obj_', dir=os.path.join('.git', 'objects'))
+    return (os.fdopen(fd, 'wb'), temp_path)
+
+
+def install_object_temp(temp_path, sha1):
+
+    if object_exists(sha1):
+        os.remove(temp_path)
+        return
+    place_object_temp(temp_path, sha1)
+
+
+def place_object_temp(temp_path, sha1):
+
+    ensure_object_dirs()
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, loose_object_path(sha1))
+    remember_loose_object(sha1)
+
+
 def hash_object(data, obj_type, write=True):
 
     header = f"""{obj_type} {len(data)}""".encode()
     full_data = header + b'\x00' + data
     sha1 = hashlib.sha1(full_data).hexdigest()
-    if write:
-        path = os.path.join('.git', 'objects', sha1[:2], sha1[2:])
-        if not os.path.exists(path):
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            write_file(path, zlib.compress(full_data))
+    if write and not object_exists(sha1):
+        f, temp_path = open_object_temp()
+        with f:
+            f.write(zlib.compress(full_data))
+        install_object_temp(temp_path, sha1)
 
     return sha1
 
 
+def write_loose_object(data, obj_type, mtime=None):
+
+    # unlike hash_object this ignores packs, so the object survives the
+    # pack it came from being deleted
+    full_data = f"""{obj_type} {len(data)}""".encode() + b'\x00' + data
+    sha1 = hashlib.sha1(full_data).hexdigest()
+    path = loose_object_path(sha1)
+    if not os.path.exists(path):
+        f, temp_path = open_object_temp()
+        with f:
+            f.write(zlib.compress(full_data))
+        place_object_temp(temp_path, sha1)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return sha1
+
+
+def hash_file(path, obj_type='blob', write=True):
+
+    st = os.stat(path)
+    if st.st_size <= HASH_IN_MEMORY_SIZE:
+        # hash small files first and only compress them if the object is
+        # missing; larger ones are compressed while hashing to bound memory
+        return hash_object(read_file(path), obj_type, write)
+    header = f"""{obj_type} {st.st_size}""".encode() + b'\x00'
+    sha1 = hashlib.sha1(header)
+    temp_path = None
+    try:
+        if write:
+            compressor = zlib.compressobj()
+            temp, temp_path = open_object_temp()
+            temp.write(compressor.compress(header))
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        size = 0
+        with open(path, 'rb') as f:
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                size += n
+                sha1.update(view[:n])
+                if write:
+                    temp.write(compressor.compress(view[:n]))
+        if write and size != st.st_size:
+            # a plain hash of a growing file just won't match its entry,
+            # but a stored object must agree with its header
+            raise ValueError(f"""{path} changed size while hashing""")
+        sha1 = sha1.hexdigest()
+        if write:
+            temp.write(compressor.flush())
+            temp.close()
+            install_object_temp(temp_path, sha1)
+    except BaseException:
+        if temp_path is not None:
+            temp.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+
+    return sha1
+
+
+def hash_files(paths, obj_type='blob', write=True, jobs=None):
+
+    jobs = jobs or os.cpu_count() or 1
+    if write:
+        ensure_object_dirs()
+    get_packs()
+    if jobs == 1:
+        for path in paths:
+            yield hash_file(path, obj_type, write)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for path in paths:
+            pending.append(executor.submit(hash_file, path, obj_type, write))
+            if len(pending) >= jobs * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def loose_object_path(sha1):
+
+    return os.path.join('.git', 'objects', sha1[:2], sha1[2:])
+
+
+def read_pack_index(idx_path):
+
+    with open(idx_path, 'rb') as f:
+        index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    signature, version = struct.unpack('!4sL', index[:8])
+
+    assert signature == b'\xfftOc', \
+        f"""invalid pack index signature {signature}"""
+    assert version == 2, f"""unknown pack index version {version}"""
+
+    fanout = struct.unpack('!256L', index[8:1032])
+    pack_path = idx_path[:-4] + '.pack'
+    with open(pack_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    signature, version, num_objects = struct.unpack('!4sLL', data[:12])
+
+    assert signature == b'PACK', f"""invalid pack signature {signature}"""
+    assert version in (2, 3), f"""unknown pack version {version}"""
+    assert num_objects == fanout[255], \
+        f"""pack has {num_objects} objects, index has {fanout[255]}"""
+
+    return Pack(pack_path, num_objects, fanout, index, data)
+
+
+def get_packs(rescan=False):
+
+    global _pack_dir_mtime
+    if _pack_dir_mtime is not None and not rescan:
+        return list(_packs.values())
+
+    pack_dir = os.path.join('.git', 'objects', 'pack')
+    try:
+        mtime = os.stat(pack_dir).st_mtime_ns
+    except FileNotFoundError:
+        _packs.clear()
+        _pack_dir_mtime = -1
+        return []
+
+    if mtime != _pack_dir_mtime:
+        names = {name[:-4] for name in os.listdir(pack_dir)
+                 if name.endswith('.idx')}
+        for name in set(_packs) - names:
+            del _packs[name]
+        for name in sorted(names - set(_packs)):
+            try:
+                _packs[name] = read_pack_index(
+                    os.path.join(pack_dir, name + '.idx'))
+            except FileNotFoundError:
+                continue
+        _pack_dir_mtime = mtime
+
+    return list(_packs.values())
+
+
+def pack_object_name(pack, i):
+
+    pos = 1032 + 20 * i
+    return pack.index[pos:pos + 20]
+
+
+def pack_object_offset(pack, i):
+
+    pos = 1032 + 24 * pack.num_objects + 4 * i
+    offset, = struct.unpack('!L', pack.index[pos:pos + 4])
+    if offset & 0x80000000:
+        pos = 1032 + 28 * pack.num_objects + 8 * (offset & 0x7fffffff)
+        offset, = struct.unpack('!Q', pack.index[pos:pos + 8])
+    return offset
+
+
+def search_pack_index(pack, sha1_prefix):
+
+    lowest = bytes.fromhex((sha1_prefix + '0' * 40)[:40])
+    lo = pack.fanout[lowest[0] - 1] if lowest[0] else 0
+    hi = pack.fanout[lowest[0]]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pack_object_name(pack, mid) < lowest:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def find_packed_objects(sha1_prefix, limit=2):
+
+    objects = []
+    for pack in get_packs():
+        i = search_pack_index(pack, sha1_prefix)
+        while i < pack.num_objects and len(objects) < limit:
+            sha1 = pack_object_name(pack, i).hex()
+            if not sha1.startswith(sha1_prefix):
+                break
+            if sha1 not in objects:
+                objects.append(sha1)
+            i += 1
+    return objects
+
+
+def find_packed_object(sha1):
+
+    name = bytes.fromhex(sha1)
+    for pack in get_packs():
+        i = search_pack_index(pack, sha1)
+        if i < pack.num_objects and pack_object_name(pack, i) == name:
+            return (pack, pack_object_offset(pack, i))
+    return None
+
+
+def read_pack_entry_header(data, offset):
+
+    byte = data[offset]
+    type_num = (byte >> 4) & 7
+    size = byte & 0x0f
+    shift = 4
+    offset += 1
+    while byte & 0x80:
+        byte = data[offset]
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        offset += 1
+    return (type_num, size, offset)
+
+
+def inflate_pack_data(data, offset, size):
+
+    decompressor = zlib.decompressobj()
+    chunk_size = min(size + 64, PACK_CHUNK_SIZE)
+    chunks = []
+    while not decompressor.eof:
+        chunk = data[offset:offset + chunk_size]
+        assert chunk, 'truncated pack data'
+        chunks.append(decompressor.decompress(chunk))
+        offset += len(chunk)
+    result = b''.join(chunks)
+
+    assert len(result) == size, \
+        f"""expected size -> {size} , got {len(result)} bytes"""
+
+    return result
+
+
+def decode_varint(data, offset):
+
+    byte = data[offset]
+    value = byte & 0x7f
+    offset += 1
+    while byte & 0x80:
+        byte = data[offset]
+        value = ((value + 1) << 7) | (byte & 0x7f)
+        offset += 1
+    return (value, offset)
+
+
+def encode_varint(value):
+
+    result = [value & 0x7f]
+    value >>= 7
+    while value:
+        value -= 1
+        result.append(0x80 | (value & 0x7f))
+        value >>= 7
+    return bytes(reversed(result))
+
+
+def read_delta_size(delta, i):
+
+    size = 0
+    shift = 0
+    while True:
+        byte = delta[i]
+        i += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (size, i)
+
+
+def apply_delta(base, delta):
+
+    base_size, i = read_delta_size(delta, 0)
+
+    assert base_size == len(base), \
+        f"""expected delta base size -> {base_size} , got {len(base)} bytes"""
+
+    result_size, i = read_delta_size(delta, i)
+    base = memoryview(base)
+    result = bytearray()
+    while i < len(delta):
+        command = delta[i]
+        i += 1
+        if command & 0x80:
+            offset = size = 0
+            for k in range(4):
+                if command & (1 << k):
+                    offset |= delta[i] << (8 * k)
+                    i += 1
+            for k in range(3):
+                if command & (0x10 << k):
+                    size |= delta[i] << (8 * k)
+                    i += 1
+            result += base[offset:offset + (size or 0x10000)]
+        elif command:
+            result += delta[i:i + command]
+            i += command
+        else:
+            raise ValueError('invalid delta instruction 0')
+
+    assert len(result) == result_size, \
+        f"""expected delta result size -> {result_size} , got {len(result)} bytes"""
+
+    return bytes(result)
+
+
+def get_delta_base(key):
+
+    entry = _delta_base_cache.get(key)
+    if entry is not None:
+        _delta_base_cache.move_to_end(key)
+    return entry
+
+
+def cache_delta_base_evict(key):
+
+    global _delta_base_cache_size
+    _, data = _delta_base_cache.pop(key)
+    _delta_base_cache_size -= len(data)
+
+
+def cache_delta_base(key, obj_type, data):
+
+    global _delta_base_cache_size
+    if key in _delta_base_cache or len(data) > DELTA_BASE_CACHE_LIMIT:
+        return
+    _delta_base_cache[key] = (obj_type, data)
+    _delta_base_cache_size += len(data)
+    while _delta_base_cache_size > DELTA_BASE_CACHE_LIMIT:
+        _, (_, evicted) = _delta_base_cache.popitem(last=False)
+        _delta_base_cache_size -= len(evicted)
+
+
+def read_packed_object(pack, offset):
+
+    chain = []
+    while True:
+        cached = get_delta_base((pack.path, offset))
+        if cached is not None:
+            obj_type, data = cached
+            break
+
+        type_num, size, data_offset = read_pack_entry_header(pack.data, offset)
+        obj_type = ObjectType(type_num)
+        if obj_type == ObjectType.ofs_delta:
+            base_offset, data_offset = decode_varint(pack.data, data_offset)
+            chain.append((offset, data_offset, size))
+            offset -= base_offset
+        elif obj_type == ObjectType.ref_delta:
+            base_sha1 = pack.data[data_offset:data_offset + 20].hex()
+            chain.append((offset, data_offset + 20, size))
+            location = find_packed_object(base_sha1)
+            if location is not None and location[0].path == pack.path:
+                offset = location[1]
+            else:
+                # the base lives elsewhere and has no offset in this pack
+                obj_type, data = read_object(base_sha1)
+                offset = None
+                break
+        else:
+            obj_type = obj_type.name
+            data = inflate_pack_data(pack.data, data_offset, size)
+            break
+
+    if chain and offset is not None:
+        cache_delta_base((pack.path, offset), obj_type, data)
+    for delta_offset, data_offset, size in reversed(chain):
+        delta = inflate_pack_data(pack.data, data_offset, size)
+        data = apply_delta(data, delta)
+        cache_delta_base((pack.path, delta_offset), obj_type, data)
+
+    return (obj_type, data)
+
+
+def read_delta_result_size(data, offset):
+
+    decompressor = zlib.decompressobj()
+    head = b''
+    while len(head) < 20 and not decompressor.eof:
+        chunk = data[offset:offset + 256]
+        assert chunk, 'truncated pack data'
+        offset += len(chunk)
+        head += decompressor.decompress(chunk, 20 - len(head))
+    _, i = read_delta_size(head, 0)
+    size, _ = read_delta_size(head, i)
+    return size
+
+
+def read_packed_object_header(pack, offset):
+
+    result_size = None
+    while True:
+        cached = get_delta_base((pack.path, offset))
+        if cached is not None:
+            obj_type, data = cached
+            return (obj_type, len(data) if result_size is None else result_size)
+
+        type_num, size, data_offset = read_pack_entry_header(pack.data, offset)
+        obj_type = ObjectType(type_num)
+        if obj_type == ObjectType.ofs_delta:
+            base_offset, data_offset = decode_varint(pack.data, data_offset)
+            if result_size is None:
+                result_size = read_delta_result_size(pack.data, data_offset)
+            offset -= base_offset
+        elif obj_type == ObjectType.ref_delta:
+            base_sha1 = pack.data[data_offset:data_offset + 20].hex()
+            if result_size is None:
+                result_size = read_delta_result_size(
+                    pack.data, data_offset + 20)
+            location = find_packed_object(base_sha1)
+            if location is not None and location[0].path == pack.path:
+                offset = location[1]
+            else:
+                obj_type, _ = read_object_header(base_sha1)
+                return (obj_type, result_size)
+        else:
+            return (obj_type.name, size if result_size is None else result_size)
+
+
+def iter_inflate(decompressor, data, read_more):
+
+    while not decompressor.eof:
+        if not data:
+            data = read_more()
+            if not data:
+                break
+        chunk = decompressor.decompress(data, PACK_CHUNK_SIZE)
+        data = decompressor.unconsumed_tail
+        if chunk:
+            yield chunk
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def iter_sized_chunks(chunks, size, name):
+
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        yield chunk
+
+    assert total == size, \
+        f"""expected size -> {size} , got {total} bytes for {name}"""
+
+
+def iter_packed_object(pack, offset):
+
+    type_num, size, data_offset = read_pack_entry_header(pack.data, offset)
+    obj_type = ObjectType(type_num)
+    if obj_type in (ObjectType.ofs_delta, ObjectType.ref_delta):
+        obj_type, data = read_packed_object(pack, offset)
+        return (obj_type, len(data), iter([data]))
+
+    def read_more():
+        nonlocal data_offset
+        chunk = pack.data[data_offset:data_offset + PACK_CHUNK_SIZE]
+        data_offset += len(chunk)
+        return chunk
+
+    chunks = iter_inflate(zlib.decompressobj(), b'', read_more)
+    name = f"""offset {offset} in {pack.path}"""
+    return (obj_type.name, size, iter_sized_chunks(chunks, size, name))
+
+
+def open_loose_object(path):
+
+    f = open(path, 'rb')
+    decompressor = zlib.decompressobj()
+    head = b''
+    data = b''
+    while b'\x00' not in head:
+        if not data:
+            data = f.read(LOOSE_HEADER_SIZE)
+            if not data:
+                f.close()
+                raise ValueError(f"""truncated object {path}""")
+        head += decompressor.decompress(data, LOOSE_HEADER_SIZE)
+        data = decompressor.unconsumed_tail
+    nul_index = head.index(b'\x00')
+    obj_type, size_str = head[:nul_index].decode().split()
+    return (obj_type, int(size_str), f, decompressor, head[nul_index + 1:],
+            data)
+
+
+def read_loose_object_header(path):
+
+    obj_type, size, f, _, _, _ = open_loose_object(path)
+    f.close()
+    return (obj_type, size)
+
+
+def iter_loose_object(path):
+
+    obj_type, size, f, decompressor, rest, data = open_loose_object(path)
+
+    def iter_chunks():
+        with f:
+            if rest:
+                yield rest
+            yield from iter_inflate(
+                decompressor, data, lambda: f.read(PACK_CHUNK_SIZE))
+
+    return (obj_type, size, iter_sized_chunks(iter_chunks(), size, path))
+
+
+def get_loose_object_names(bucket):
+
+    obj_dir = os.path.join('.git', 'objects', bucket)
+    try:
+        mtime = os.stat(obj_dir).st_mtime_ns
+    except FileNotFoundError:
+        _loose_object_names.pop(bucket, None)
+        return []
+
+    cached = _loose_object_names.get(bucket)
+    if cached is None or cached[0] != mtime:
+        with _loose_object_names_lock:
+            listed_at = time.time_ns()
+            names = sorted(name for name in os.listdir(obj_dir)
+                           if len(name) == 38)
+            if mtime >= listed_at - RACY_INTERVAL_NS:
+                # the directory may still change within its mtime granularity
+                mtime = None
+            cached = (mtime, names)
+            _loose_object_names[bucket] = cached
+
+    return cached[1]
+
+
+def find_loose_objects(sha1_prefix, limit=2):
+
+    bucket, rest = sha1_prefix[:2], sha1_prefix[2:]
+    names = get_loose_object_names(bucket)
+    i = bisect.bisect_left(names, rest)
+    objects = []
+    while i < len(names) and len(objects) < limit:
+        if not names[i].startswith(rest):
+            break
+        objects.append(bucket + names[i])
+        i += 1
+    return objects
+
+
+def find_object_names(sha1_prefix):
+
+    if not HEX_DIGITS.issuperset(sha1_prefix):
+        return set()
+    if len(sha1_prefix) == 40:
+        if (find_packed_object(sha1_prefix) is not None or
+                os.path.exists(loose_object_path(sha1_prefix))):
+            return {sha1_prefix}
+        return set()
+    return (set(find_loose_objects(sha1_prefix)) |
+            set(find_packed_objects(sha1_prefix)))
+
+
+def match_objects(sha1_prefix):
+
+    objects = find_object_names(sha1_prefix)
+    if not objects:
+        get_packs(rescan=True)
+        objects = find_object_names(sha1_prefix)
+    return objects
+
+
 def find_object(sha1_prefix):
 
     if len(sha1_prefix) < 2:
         raise ValueError("hash prefix must be 2 or more characters")
 
-    obj_dir = os.path.join('.git', 'objects', sha1_prefix[:2])
-    rest = sha1_prefix[2:]
-    objects = [name for name in os.listdir(obj_dir) if name.startswith(rest)]
+    sha1_prefix = sha1_prefix.lower()
+    objects = match_objects(sha1_prefix)
 
     if not objects:
         raise ValueError(f"""object {sha1_prefix} not found""")
     if len(objects) >= 2:
-        raise ValueError(
-            f"""multiple objects ({len(objects)}) with prefix {sha1_prefix}""")
+        raise ValueError(f"""multiple objects with prefix {sha1_prefix}""")
+
+    return objects.pop()
+
+
+def read_object_header(sha1_prefix):
 
-    return os.path.join(obj_dir, objects[0])
+    sha1 = find_object(sha1_prefix)
+    location = find_packed_object(sha1)
+    if location is not None:
+        return read_packed_object_header(*location)
+    return read_loose_object_header(loose_object_path(sha1))
+
+
+def iter_object(sha1_prefix):
+
+    sha1 = find_object(sha1_prefix)
+    location = find_packed_object(sha1)
+    if location is not None:
+        return iter_packed_object(*location)
+    return iter_loose_object(loose_object_path(sha1))
 
 
 def read_object(sha1_prefix):
 
-    path = find_object(sha1_prefix)
-    full_data = zlib.decompress(read_file(path))
-    nul_index = full_data.index(b'\x00')
-    header = full_data[:nul_index]
-    obj_type, size_str = header.decode().split()
-    size = int(size_str)
-    data = full_data[nul_index + 1:]
+    sha1 = find_object(sha1_prefix)
+    location = find_packed_object(sha1)
+    if location is not None:
+        return read_packed_object(*location)
 
-    assert size == len(
-        data), f"""expected size -> {size} , got {len(data)} bytes"""
+    obj_type, _, chunks = iter_loose_object(loose_object_path(sha1))
+    data = b''.join(chunks)
 
     return (obj_type, data)
 
 
 def cat_file(mode, sha1_prefix):
 
-    obj_type, data = read_object(sha1_prefix)
+    if mode == 'size':
+        print(read_object_header(sha1_prefix)[1])
+        return
+    elif mode == 'type':
+        print(read_object_header(sha1_prefix)[0])
+        return
+
+    obj_type, size, chunks = iter_object(sha1_prefix)
     if mode in ['commit', 'tree', 'blob']:
         if obj_type != mode:
             raise ValueError('expected object type {}, got {}'.format(
                 mode, obj_type))
-        sys.stdout.buffer.write(data)
-    elif mode == 'size':
-        print(len(data))
-    elif mode == 'type':
-        print(obj_type)
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
     elif mode == 'pretty':
         if obj_type in ['commit', 'blob']:
-            sys.stdout.buffer.write(data)
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
         elif obj_type == 'tree':
-            for mode, path, sha1 in read_tree(data=data):
+            for mode, path, sha1 in read_tree(data=b''.join(chunks)):
                 type_str = 'tree' if stat.S_ISDIR(mode) else 'blob'
                 print('{:06o} {} {}\t{}'.format(mode, type_str, sha1, path))
         else:
@@ -127,96 +950,1409 @@ def cat_file(mode, sha1_prefix):
         raise ValueError('unexpected mode {!r}'.format(mode))
 
 
+def cat_file_batch(contents=True):
+
+    out = sys.stdout.buffer
+    for line in sys.stdin.buffer:
+        name = line.rstrip(b'\r\n').decode()
+        objects = match_objects(name.lower()) if len(name) >= 2 else set()
+        if len(objects) != 1:
+            status = 'ambiguous' if objects else 'missing'
+            out.write(f"""{name} {status}\n""".encode())
+        elif contents:
+            sha1 = objects.pop()
+            obj_type, size, chunks = iter_object(sha1)
+            out.write(f"""{sha1} {obj_type} {size}\n""".encode())
+            for chunk in chunks:
+                out.write(chunk)
+            out.write(b'\n')
+        else:
+            sha1 = objects.pop()
+            obj_type, size = read_object_header(sha1)
+            out.write(f"""{sha1} {obj_type} {size}\n""".encode())
+        out.flush()
+
+
+class Index:
+
+    # Entries are kept as columns: one array per stat field, the SHA-1s
+    # and paths each in a single buffer, so a large index costs a few
+    # objects instead of a namedtuple per entry. Indexing or iterating
+    # still yields IndexEntry tuples for existing callers.
+
+    def __init__(self, stat_columns, sha1s, flags, path_data, path_lengths):
+        self.stat_columns = stat_columns
+        self.columns = dict(zip(INDEX_STAT_FIELDS, stat_columns))
+        self.sha1s = sha1s
+        self.flags = flags
+        self.path_data = path_data
+        self.path_lengths = path_lengths
+        self._heads = None
+        self._path_offsets = None
+        self._paths = None
+
+    @classmethod
+    def from_entries(cls, entries):
+        entries = list(entries)
+        stat_columns = [array.array('I', (e[f] for e in entries))
+                        for f in range(len(INDEX_STAT_FIELDS))]
+        paths = [e.path.encode() for e in entries]
+        return cls(stat_columns, b''.join(e.sha1 for e in entries),
+                   array.array('H', (e.flags for e in entries)),
+                   b''.join(paths), array.array('I', map(len, paths)))
+
+    @classmethod
+    def from_heads(cls, heads, path_data, path_lengths):
+        # heads holds the fixed 62 bytes of each entry as stored on disk;
+        # each field is gathered with strided slices instead of a loop
+        def gather(offset, size, typecode):
+            field = bytearray(size * len(path_lengths))
+            for j in range(size):
+                field[j::size] = heads[offset + j::62]
+            column = array.array(typecode, field)
+            if sys.byteorder == 'little':
+                column.byteswap()
+            return column
+
+        stat_columns = [gather(4 * f, 4, 'I')
+                        for f in range(len(INDEX_STAT_FIELDS))]
+        sha1s = bytearray(20 * len(path_lengths))
+        for j in range(20):
+            sha1s[j::20] = heads[40 + j::62]
+        return cls(stat_columns, bytes(sha1s), gather(60, 2, 'H'), path_data,
+                   path_lengths)
+
+    @classmethod
+    def concat(cls, runs):
+        stat_columns = [array.array('I') for _ in INDEX_STAT_FIELDS]
+        sha1s = []
+        flags = array.array('H')
+        path_data = []
+        path_lengths = array.array('I')
+        for index, start, end in runs:
+            for column, source in zip(stat_columns, index.stat_columns):
+                column.extend(source[start:end])
+            sha1s.append(index.sha1s[20 * start:20 * end])
+            flags.extend(index.flags[start:end])
+            offsets = index.path_offsets()
+            path_data.append(index.path_data[offsets[start]:offsets[end]])
+            path_lengths.extend(index.path_lengths[start:end])
+        return cls(stat_columns, b''.join(sha1s), flags, b''.join(path_data),
+                   path_lengths)
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('index entry out of range')
+        return IndexEntry(*(c[k] for c in self.stat_columns), self.sha1(k),
+                          self.flags[k], self.path(k))
+
+    def __iter__(self):
+        sha1s = (self.sha1s[i:i + 20] for i in range(0, len(self.sha1s), 20))
+        return map(IndexEntry._make, zip(*self.stat_columns, sha1s,
+                                         self.flags, self.paths()))
+
+    def with_column(self, name, column):
+        stat_columns = [column if f == name else self.columns[f]
+                        for f in INDEX_STAT_FIELDS]
+        index = Index(stat_columns, self.sha1s, self.flags, self.path_data,
+                      self.path_lengths)
+        index._path_offsets = self._path_offsets
+        index._paths = self._paths
+        return index
+
+    def path_offsets(self):
+        if self._path_offsets is None:
+            self._path_offsets = array.array('Q', itertools.accumulate(
+                self.path_lengths, initial=0))
+        return self._path_offsets
+
+    def paths(self):
+        if self._paths is None:
+            offsets = self.path_offsets()
+            data = self.path_data
+            if data.isascii():
+                # byte and character offsets agree, so decode only once
+                data = data.decode()
+            pairs = zip(offsets, itertools.islice(offsets, 1, None))
+            if isinstance(data, str):
+                self._paths = [data[a:b] for a, b in pairs]
+            else:
+                self._paths = [data[a:b].decode() for a, b in pairs]
+        return self._paths
+
+    def path(self, k):
+        if self._paths is not None:
+            return self._paths[k]
+        offsets = self.path_offsets()
+        return self.path_data[offsets[k]:offsets[k + 1]].decode()
+
+    def sha1(self, k):
+        return self.sha1s[20 * k:20 * k + 20]
+
+    def heads(self):
+        if self._heads is None:
+            n = len(self)
+            stat = array.array('I', bytes(4 * len(INDEX_STAT_FIELDS) * n))
+            for f, column in enumerate(self.stat_columns):
+                stat[f::len(INDEX_STAT_FIELDS)] = column
+            flags = array.array('H', self.flags)
+            if sys.byteorder == 'little':
+                stat.byteswap()
+                flags.byteswap()
+            stat = stat.tobytes()
+            flags = flags.tobytes()
+            heads = bytearray(62 * n)
+            for j in range(40):
+                heads[j::62] = stat[j::40]
+            for j in range(20):
+                heads[40 + j::62] = self.sha1s[j::20]
+            for j in range(2):
+                heads[60 + j::62] = flags[j::2]
+            self._heads = bytes(heads)
+        return self._heads
+
+
+def parse_index(data):
+
+    if data[-20:] != NULL_SHA1:
+        # an all-zero trailer means the writer skipped the checksum
+        digest = hashlib.sha1(memoryview(data)[:-20]).digest()
+        assert digest == data[-20:], f"""invalid index checksum"""
+
+    signature, version, num_entries = struct.unpack('!4sLL', data[:12])
+
+    assert signature == b'DIRC', f"""invalid index signature {signature}"""
+    assert version in INDEX_VERSIONS, f"""unknown index version {version}"""
+
+    # copy into preallocated buffers through a memoryview so no
+    # per-entry bytes objects are created
+    view = memoryview(data)
+    heads = bytearray(62 * num_entries)
+    paths = bytearray()
+    path_lengths = array.array('I', bytes(4 * num_entries))
+    i = 12
+    if version == 4:
+        # paths are stored as the number of bytes to drop from the end of
+        # the previous path followed by the new suffix, without padding
+        path_len = 0
+        for k in range(num_entries):
+            heads[62 * k:62 * k + 62] = view[i:i + 62]
+            strip = data[i + 62]
+            if strip & 0x80:
+                strip, i = decode_varint(data, i + 62)
+            else:
+                i += 63
+            path_end = data.index(b'\x00', i)
+            paths += paths[len(paths) - path_len:len(paths) - strip]
+            paths += view[i:path_end]
+            path_len += path_end - i - strip
+            path_lengths[k] = path_len
+            i = path_end + 1
+    else:
+        for k in range(num_entries):
+            path_len = ((data[i + 60] << 8) | data[i + 61]) & 0xfff
+            if path_len == 0xfff:
+                path_len = data.index(b'\x00', i + 62) - i - 62
+            heads[62 * k:62 * k + 62] = view[i:i + 62]
+            paths += view[i + 62:i + 62 + path_len]
+            path_lengths[k] = path_len
+            i += (70 + path_len) & ~7
+    entries = Index.from_heads(heads, paths, path_lengths)
+
+    extensions = {}
+    while i < len(data) - 20:
+        signature, size = struct.unpack('!4sL', data[i:i + 8])
+        if signature in INDEX_EXTENSIONS:
+            extensions[signature] = data[i + 8:i + 8 + size]
+        else:
+            assert b'A' <= signature[:1] <= b'Z', \
+                f"""unsupported index extension {signature}"""
+        i += 8 + size
+
+    return (entries, extensions)
+
+
+def shared_index_path(sha1):
+
+    return os.path.join('.git', 'sharedindex.' + sha1)
+
+
+def read_shared_index(sha1):
+
+    entries = _shared_index.get(sha1)
+    if entries is None:
+        data = read_file(shared_index_path(sha1))
+        assert data[-20:].hex() == sha1, \
+            f"""shared index {sha1} has checksum {data[-20:].hex()}"""
+        entries = parse_index(data)[0]
+        _shared_index.clear()
+        _shared_index[sha1] = entries
+    return entries
+
+
+def merge_split_index(entries, link):
+
+    base = read_shared_index(link[:20].hex())
+    deleted, replaced = (), ()
+    if len(link) > 20:
+        deleted, i = decode_ewah(link, 20)
+        replaced, _ = decode_ewah(link, i)
+    assert len(replaced) <= len(entries), \
+        f"""corrupt link extension: {len(replaced)} replacements"""
+    if not deleted and not replaced and not entries:
+        return base
+
+    # replacements are stored first, without a name
+    replacements = []
+    for entry, position in zip(entries, replaced):
+        assert not entry.path, \
+            f"""corrupt link extension: entry {entry.path} has a name"""
+        path = base.path(position)
+        flags = (entry.flags & ~0xfff) | min(len(path.encode()), 0xfff)
+        replacements.append(entry._replace(flags=flags, path=path))
+    replacements = Index.from_entries(replacements)
+
+    # the merged index is assembled from runs of unchanged base entries
+    # with the replaced, deleted and added entries spliced in between
+    rows = dict.fromkeys(deleted)
+    rows.update((p, (replacements, k)) for k, p in enumerate(replaced))
+    inserts = collections.defaultdict(list)
+    base_paths = base.paths()
+    for k in range(len(replaced), len(entries)):
+        path = entries.path(k)
+        position = bisect.bisect_left(base_paths, path)
+        if position < len(base) and base_paths[position] == path:
+            rows[position] = (entries, k)
+        else:
+            inserts[position].append((entries, k))
+
+    runs = []
+    start = 0
+    for position in sorted(rows.keys() | inserts.keys()):
+        if start < position:
+            runs.append((base, start, position))
+        runs.extend((index, k, k + 1) for index, k in inserts[position])
+        start = position
+        if position in rows:
+            if rows[position] is not None:
+                index, k = rows[position]
+                runs.append((index, k, k + 1))
+            start += 1
+    if start < len(base):
+        runs.append((base, start, len(base)))
+    return Index.concat(runs)
+
+
+def update_index_entries(entries, updates):
+
+    # updates maps a path to its new entry, or to None to remove it; the
+    # result is spliced from runs of unchanged entries in a single pass
+    paths = entries.paths()
+    new_paths = sorted(updates)
+    added = Index.from_entries(updates[p] for p in new_paths
+                               if updates[p] is not None)
+    runs = []
+    start = 0
+    k = 0
+    for path in new_paths:
+        position = bisect.bisect_left(paths, path, start)
+        if start < position:
+            runs.append((entries, start, position))
+        start = position
+        while start < len(paths) and paths[start] == path:
+            start += 1
+        if updates[path] is not None:
+            if runs and runs[-1][0] is added and runs[-1][2] == k:
+                runs[-1] = (added, runs[-1][1], k + 1)
+            else:
+                runs.append((added, k, k + 1))
+            k += 1
+    if start < len(entries):
+        runs.append((entries, start, len(entries)))
+    return Index.concat(runs)
+
+
+def read_index_file():
+
+    global _index_cache
+    path = os.path.join('.git', 'index')
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return (Index.from_entries([]), {})
+
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    if _index_cache is None or _index_cache[0] != key:
+        entries, extensions = parse_index(read_file(path))
+        if b'link' in extensions:
+            entries = merge_split_index(entries, extensions[b'link'])
+        _index_cache = (key, entries, extensions)
+    return (_index_cache[1], dict(_index_cache[2]))
+
+
 def read_index():
 
+    return read_index_file()[0]
+
+
+def get_index_mtime():
+
     try:
-        data = read_file(os.path.join('.git', 'index'))
+        return os.stat(os.path.join('.git', 'index')).st_mtime_ns
     except FileNotFoundError:
-        return []
+        return None
 
-    digest = hashlib.sha1(data[:-20]).digest()
 
-    assert digest == data[-20:], f"""invalid index checksum"""
+def index_entry_from_stat(path, sha1, st):
 
-    signature, version, num_entries = struct.unpack('!4sLL', data[:12])
+    flags = len(path.encode())
 
-    assert signature == b'DIRC', f"""invalid index signature {signature}"""
-    assert version == 2, f"""unknown index version {version}"""
+    assert flags < (1 << 12)
 
-    entry_data = data[12:-20]
-    entries = []
+    return IndexEntry(
+        st.st_ctime_ns // 1000000000, st.st_ctime_ns % 1000000000,
+        st.st_mtime_ns // 1000000000, st.st_mtime_ns % 1000000000,
+        st.st_dev & 0xffffffff, st.st_ino & 0xffffffff, st.st_mode,
+        st.st_uid & 0xffffffff, st.st_gid & 0xffffffff,
+        st.st_size & 0xffffffff, bytes.fromhex(sha1), flags, path)
+
+
+def index_entry_is_clean(entries, k, st, index_mtime):
+
+    columns = entries.columns
+    stat_data = tuple(columns[f][k] for f in (
+        'ctime_s', 'ctime_n', 'mtime_s', 'mtime_n', 'dev', 'ino', 'uid',
+        'gid', 'size'))
+    return (columns['mode'][k] == st.st_mode and
+            stat_data_is_clean(stat_data, get_stat_data(st), index_mtime))
+
+
+def smudge_racy_entries(entries, index_mtime):
+
+    # rewriting the index makes racily clean entries look clean, so zero
+    # their size to force the contents to be compared next time
+    sizes = array.array('I', (
+        0 if index_mtime is None or s * 1000000000 + n >= index_mtime else size
+        for s, n, size in zip(entries.columns['mtime_s'],
+                              entries.columns['mtime_n'],
+                              entries.columns['size'])))
+    return entries.with_column('size', sizes)
+
+
+def parse_pathspec(spec):
+
+    spec = spec.replace('\\', '/')
+    dir_only = spec.endswith('/') and spec.strip('/') not in ('', '.')
+    path = os.path.normpath(spec)
+    path = '' if path == '.' else path
+    wildcard = re.search(r'[*?[]', path)
+    if wildcard is None:
+        return Pathspec(path, path, None, dir_only)
+    regex = re.compile(translate_ignore_glob(path, pathname=False), re.DOTALL)
+    return Pathspec(path, path[:wildcard.start()], regex, dir_only)
+
+
+def pathspec_matcher(pathspecs):
+
+    # literal pathspecs match themselves and everything below them, globs
+    # must match the whole path
+    files = {s.path for s in pathspecs if s.regex is None and not s.dir_only}
+    dirs = {s.path for s in pathspecs if s.regex is None}
+    globs = [s.regex for s in pathspecs if s.regex is not None]
+
+    def matches(path):
+        if '' in dirs or path in files:
+            return True
+        if any(regex.fullmatch(path) for regex in globs):
+            return True
+        i = path.rfind('/')
+        while i > 0:
+            if path[:i] in dirs:
+                return True
+            i = path.rfind('/', 0, i)
+        return False
+
+    return matches
+
+
+def pathspec_range(paths, pathspec):
+
+    # sorted paths sharing the literal prefix form one contiguous range
+    prefix = pathspec.prefix
+    if not prefix:
+        return (0, len(paths))
+    start = bisect.bisect_left(paths, prefix)
+    if pathspec.regex is None:
+        # the path itself and everything below sorts before path + '0'
+        end = bisect.bisect_left(paths, prefix + '0', start)
+    else:
+        end = bisect.bisect_left(paths, prefix[:-1] + chr(ord(prefix[-1]) + 1),
+                                 start)
+    return (start, end)
+
+
+def match_index_pathspecs(entries, pathspecs):
+
+    if not pathspecs:
+        return range(len(entries))
+    paths = entries.paths()
+    matches = pathspec_matcher(pathspecs)
+    positions = []
+    done = 0
+    for start, end in sorted(pathspec_range(paths, s) for s in pathspecs):
+        positions.extend(k for k in range(max(start, done), end)
+                         if matches(paths[k]))
+        done = max(done, end)
+    return positions
+
+
+def scan_pathspecs(jobs, patterns, pathspecs, ignored_files=False):
+
+    # only the directories below each pathspec's literal prefix are walked;
+    # files named explicitly are only taken when ignored if ignored_files
+    files = {}
+    roots = []
+    for pathspec in pathspecs:
+        path = pathspec.path
+        if pathspec.regex is None and os.path.isdir(path or '.'):
+            roots.append(path + '/' if path else '')
+        elif pathspec.regex is None:
+            if not os.path.exists(path) or pathspec.dir_only:
+                continue
+            if not ignored_files:
+                directory = path[:path.rfind('/') + 1]
+                dir_patterns = get_directory_patterns(directory, patterns)
+                if dir_patterns is None or is_ignored(
+                        dir_patterns + read_ignore_file(
+                            directory + '.gitignore', directory),
+                        path, False):
+                    continue
+            files[path] = os.stat(path)
+        else:
+            roots.append(pathspec.prefix[:pathspec.prefix.rfind('/') + 1])
+    walked = []
+    for directory in sorted(roots):
+        if walked and directory.startswith(walked[-1]):
+            continue
+        if not os.path.isdir(directory or '.'):
+            continue
+        walked.append(directory)
+        dir_patterns = get_directory_patterns(directory, patterns)
+        if dir_patterns is not None:
+            files.update(scan_worktree(jobs, dir_patterns, directory))
+    matches = pathspec_matcher(pathspecs)
+    return {path: st for path, st in files.items() if matches(path)}
+
+
+def ls_files(details=False, pathspecs=(), null_terminated=False):
+
+    pathspecs = [parse_pathspec(p) for p in pathspecs]
+    entries = read_index()
+    terminator = b'\x00' if null_terminated else b'\n'
+    offsets = entries.path_offsets()
+    path_data = entries.path_data
+    modes = entries.columns['mode']
+    out = sys.stdout.buffer
+    # lines are formatted straight from the index buffers and written in
+    # batches rather than printing one decoded entry at a time
+    positions = match_index_pathspecs(entries, pathspecs)
+    for i in range(0, len(positions), 4096):
+        lines = []
+        for k in positions[i:i + 4096]:
+            path = path_data[offsets[k]:offsets[k + 1]]
+            if details:
+                stage = (entries.flags[k] >> 12) & 3
+                lines.append(b'%6o %s %d\t' % (
+                    modes[k], entries.sha1(k).hex().encode(), stage))
+            lines.append(path)
+            lines.append(terminator)
+        out.write(b''.join(lines))
+    out.flush()
+
+
+def translate_ignore_glob(pattern, pathname=True):
+
+    # without pathname, as in pathspecs, wildcards also match '/'
+    result = []
     i = 0
-    while i + 62 < len(entry_data):
-        fields_end = i + 62
-        fields = struct.unpack('!LLLLLLLLLL20sH', entry_data[i:fields_end])
-        path_end = entry_data.index(b'\x00', fields_end)
-        path = entry_data[fields_end:path_end]
-        entry = IndexEntry(*(fields + (path.decode(),)))
-        entries.append(entry)
-        entry_len = ((62 + len(path) + 8) // 8) * 8
-        i += entry_len
-
-    assert len(entries) == num_entries
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*' and not pathname:
+            while i < n and pattern[i] == '*':
+                i += 1
+            result.append('.*')
+            continue
+        if c == '*':
+            if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/'):
+                if i + 2 == n:
+                    result.append('.*')
+                    i += 2
+                    continue
+                if pattern[i + 2] == '/':
+                    result.append('(?:.*/)?')
+                    i += 3
+                    continue
+            while i < n and pattern[i] == '*':
+                i += 1
+            result.append('[^/]*')
+            continue
+        if c == '?':
+            result.append('[^/]' if pathname else '.')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j == -1:
+                result.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                if body[0] in '!^':
+                    body = '^' + body[1:]
+                result.append('[' + body.replace('[', '\\[') + ']')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            result.append(re.escape(pattern[i]))
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return ''.join(result)
+
+
+def parse_ignore_pattern(line, base):
+
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    elif line.startswith(('\\!', '\\#')):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    if dir_only:
+        line = line[:-1]
+    anchored = '/' in line
+    line = line.lstrip('/')
+    if not line:
+        return None
+    regex = re.compile(translate_ignore_glob(line), re.DOTALL)
+    return IgnorePattern(regex, negate, dir_only, anchored, base)
+
+
+def parse_ignore_data(data, base=''):
+
+    patterns = (parse_ignore_pattern(line, base)
+                for line in data.decode(errors='replace').splitlines())
+    return tuple(p for p in patterns if p is not None)
+
+
+def read_ignore_file(path, base=''):
+
+    try:
+        data = read_file(path)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return ()
+    return parse_ignore_data(data, base)
+
+
+def get_excludes_file():
+
+    excludes_file = get_config('core.excludesFile')
+    if excludes_file is None:
+        config_home = (os.environ.get('XDG_CONFIG_HOME') or
+                       os.path.join(os.path.expanduser('~'), '.config'))
+        excludes_file = os.path.join(config_home, 'git', 'ignore')
+    return os.path.expanduser(excludes_file)
+
+
+def get_exclude_patterns():
+
+    return (read_ignore_file(get_excludes_file()) +
+            read_ignore_file(os.path.join('.git', 'info', 'exclude')))
+
+
+def get_directory_patterns(directory, patterns=()):
+
+    # a walk starting below the top also honours the parents' .gitignore;
+    # None means the directory or one of its parents is ignored
+    prefix = ''
+    for name in directory.split('/')[:-1]:
+        patterns += read_ignore_file(prefix + '.gitignore', prefix)
+        prefix += name + '/'
+        if is_ignored(patterns, prefix[:-1], True):
+            return None
+    return patterns
+
+
+def is_ignored(patterns, path, is_dir):
+
+    name = path[path.rfind('/') + 1:]
+    for pattern in reversed(patterns):
+        if pattern.dir_only and not is_dir:
+            continue
+        if pattern.anchored:
+            if (not path.startswith(pattern.base) or
+                    not pattern.regex.fullmatch(path, len(pattern.base))):
+                continue
+        elif not pattern.regex.fullmatch(name):
+            continue
+        return not pattern.negate
+    return False
+
+
+def classify_entries(directory, entries, patterns):
+
+    files = []
+    dirs = []
+    for entry in entries:
+        path = directory + entry.name
+        if entry.is_dir():
+            if (entry.name != '.git' and not entry.is_symlink() and
+                    not is_ignored(patterns, path, True)):
+                dirs.append((path + '/', patterns))
+            continue
+        if is_ignored(patterns, path, False):
+            continue
+        try:
+            st = entry.stat()
+        except OSError:
+            # dangling symlinks keep their own stat data; files removed
+            # since the listing are skipped
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+        files.append((path, st))
+    return (files, dirs)
+
+
+def list_directory(directory):
+
+    # like os.walk, a directory that vanished or can't be read is skipped
+    try:
+        with os.scandir(directory or '.') as it:
+            return list(it)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
 
-    return entries
 
+def scan_directory(directory, patterns=()):
 
-def ls_files(details=False):
+    entries = list_directory(directory)
+    if any(entry.name == '.gitignore' for entry in entries):
+        patterns += read_ignore_file(directory + '.gitignore', directory)
+    return classify_entries(directory, entries, patterns)
 
-    for entry in read_index():
-        if details:
-            stage = (entry.flags >> 12) & 3
-            print('{:6o} {} {:}\t{}'.format(
-                entry.mode, entry.sha1.hex(), stage, entry.path))
+
+def scan_worktree(jobs=None, patterns=(), directory=''):
+
+    jobs = jobs or os.cpu_count() or 1
+    files = {}
+    pending = [(directory, patterns)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending:
+            if jobs == 1 or len(pending) == 1:
+                scans = [scan_directory(*item) for item in pending]
+            else:
+                scans = executor.map(lambda item: scan_directory(*item),
+                                     pending)
+            pending = []
+            for dir_files, dirs in scans:
+                files.update(dir_files)
+                pending.extend(dirs)
+    return files
+
+
+def get_stat_data(st):
+
+    return (st.st_ctime_ns // 1000000000, st.st_ctime_ns % 1000000000,
+            st.st_mtime_ns // 1000000000, st.st_mtime_ns % 1000000000,
+            st.st_dev & 0xffffffff, st.st_ino & 0xffffffff,
+            st.st_uid & 0xffffffff, st.st_gid & 0xffffffff,
+            st.st_size & 0xffffffff)
+
+
+def stat_data_is_clean(stat_data, new_stat_data, index_mtime):
+
+    mtime = stat_data[2] * 1000000000 + stat_data[3]
+    if index_mtime is None or mtime >= index_mtime:
+        # racily clean: the file may have changed again within the
+        # timestamp granularity after the index was written
+        return False
+    # like git, the device number is not compared
+    return (stat_data[:4] == new_stat_data[:4] and
+            stat_data[5:] == new_stat_data[5:])
+
+
+def encode_ewah(positions):
+
+    positions = sorted(positions)
+    bit_size = positions[-1] + 1 if positions else 0
+    literals = [0] * ((bit_size + 63) // 64)
+    for position in positions:
+        literals[position // 64] |= 1 << (position % 64)
+    words = [len(literals) << 33] + literals
+    return struct.pack(f"""!LL{len(words)}QL""", bit_size, len(words),
+                       *words, 0)
+
+
+def decode_ewah(data, i):
+
+    bit_size, num_words = struct.unpack('!LL', data[i:i + 8])
+    i += 8
+    words = struct.unpack(f"""!{num_words}Q""", data[i:i + 8 * num_words])
+    i += 8 * num_words + 4
+    positions = []
+    position = 0
+    k = 0
+    while k < num_words:
+        marker = words[k]
+        k += 1
+        running_length = (marker >> 1) & 0xffffffff
+        if marker & 1:
+            positions.extend(range(position, position + 64 * running_length))
+        position += 64 * running_length
+        for word in words[k:k + (marker >> 33)]:
+            while word:
+                low_bit = word & -word
+                positions.append(position + low_bit.bit_length() - 1)
+                word ^= low_bit
+            position += 64
+        k += marker >> 33
+    return ([p for p in positions if p < bit_size], i)
+
+
+def untracked_cache_ident():
+
+    return 'Location {}, system {}\x00'.format(
+        os.path.realpath(os.getcwd()), platform.system()).encode()
+
+
+def get_exclude_oid(data, tracked_sha1=None):
+
+    sha1 = bytes.fromhex(hash_object(data, 'blob', write=False))
+    if not data or sha1 == tracked_sha1:
+        return sha1
+    # git appends a newline before hashing exclude files it read from disk
+    return bytes.fromhex(hash_object(data + b'\n', 'blob', write=False))
+
+
+def get_exclude_file_state(path):
+
+    try:
+        st = os.lstat(path)
+        data = read_file(path)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return ((0,) * 9, NULL_SHA1)
+    return (get_stat_data(st), get_exclude_oid(data))
+
+
+def new_untracked_cache(root=None):
+
+    return UntrackedCache(
+        untracked_cache_ident(),
+        get_exclude_file_state(os.path.join('.git', 'info', 'exclude')),
+        get_exclude_file_state(get_excludes_file()),
+        0, '.gitignore', root)
+
+
+def parse_untracked_cache(data):
+
+    ident_len, i = decode_varint(data, 0)
+    ident = data[i:i + ident_len]
+    i += ident_len
+    info_exclude_stat = struct.unpack('!9L', data[i:i + 36])
+    excludes_file_stat = struct.unpack('!9L', data[i + 36:i + 72])
+    dir_flags, = struct.unpack('!L', data[i + 72:i + 76])
+    info_exclude = (info_exclude_stat, data[i + 76:i + 96])
+    excludes_file = (excludes_file_stat, data[i + 96:i + 116])
+    i += 116
+    end = data.index(b'\x00', i)
+    exclude_per_dir = data[i:end].decode()
+    num_dirs, i = decode_varint(data, end + 1)
+    cache = UntrackedCache(ident, info_exclude, excludes_file, dir_flags,
+                           exclude_per_dir, None)
+    if not num_dirs:
+        return cache
+
+    blocks = []
+    for _ in range(num_dirs):
+        num_untracked, i = decode_varint(data, i)
+        num_subdirs, i = decode_varint(data, i)
+        names = []
+        for _ in range(num_untracked + 1):
+            end = data.index(b'\x00', i)
+            names.append(data[i:end].decode())
+            i = end + 1
+        blocks.append((names[0], names[1:], num_subdirs))
+    valid, i = decode_ewah(data, i)
+    check_only, i = decode_ewah(data, i)
+    sha1_valid, i = decode_ewah(data, i)
+    stat_data = {}
+    for position in valid:
+        stat_data[position] = struct.unpack('!9L', data[i:i + 36])
+        i += 36
+    exclude_oids = {}
+    for position in sha1_valid:
+        exclude_oids[position] = data[i:i + 20]
+        i += 20
+    check_only = set(check_only)
+
+    def build(k):
+        name, untracked, num_subdirs = blocks[k]
+        position = k
+        dirs = []
+        k += 1
+        for _ in range(num_subdirs):
+            child, k = build(k)
+            dirs.append(child)
+        node = UntrackedDir(name, position in stat_data,
+                            position in check_only, stat_data.get(position),
+                            exclude_oids.get(position, NULL_SHA1),
+                            untracked if position in stat_data else [], dirs)
+        return (node, k)
+
+    return cache._replace(root=build(0)[0])
+
+
+def encode_untracked_cache(cache):
+
+    result = [encode_varint(len(cache.ident)), cache.ident,
+              struct.pack('!9L', *cache.info_exclude[0]),
+              struct.pack('!9L', *cache.excludes_file[0]),
+              struct.pack('!L', cache.dir_flags),
+              cache.info_exclude[1], cache.excludes_file[1],
+              cache.exclude_per_dir.encode() + b'\x00']
+    if cache.root is None:
+        result.append(encode_varint(0))
+        return b''.join(result)
+
+    nodes = []
+    blocks = []
+
+    def walk(node):
+        dirs = sorted(node.dirs, key=operator.attrgetter('name'))
+        untracked = node.untracked if node.valid else []
+        nodes.append(node)
+        blocks.append(encode_varint(len(untracked)) + encode_varint(len(dirs)) +
+                      b''.join(name.encode() + b'\x00'
+                               for name in [node.name] + untracked))
+        for child in dirs:
+            walk(child)
+
+    walk(cache.root)
+    result.append(encode_varint(len(nodes)))
+    result.extend(blocks)
+    result.append(encode_ewah(k for k, n in enumerate(nodes) if n.valid))
+    result.append(encode_ewah(k for k, n in enumerate(nodes) if n.check_only))
+    result.append(encode_ewah(k for k, n in enumerate(nodes)
+                              if n.exclude_oid != NULL_SHA1))
+    result.extend(struct.pack('!9L', *n.stat_data) for n in nodes if n.valid)
+    result.extend(n.exclude_oid for n in nodes if n.exclude_oid != NULL_SHA1)
+    result.append(b'\x00')
+    return b''.join(result)
+
+
+def load_untracked_cache(data):
+
+    if data is None:
+        return None
+    cache = parse_untracked_cache(data)
+    current = new_untracked_cache()
+    if (cache.ident != current.ident or
+            cache.dir_flags != current.dir_flags or
+            cache.exclude_per_dir != current.exclude_per_dir or
+            cache.info_exclude[1] != current.info_exclude[1] or
+            cache.excludes_file[1] != current.excludes_file[1]):
+        return None
+    return cache
+
+
+def invalidate_untracked_dir(node, names):
+
+    if not names:
+        return node._replace(valid=False, untracked=[])
+    return node._replace(dirs=[
+        invalidate_untracked_dir(d, names[1:]) if d.name == names[0] else d
+        for d in node.dirs])
+
+
+def scan_directory_cached(directory, patterns, cached, entries, tracked,
+                          index_mtime, touched_dirs=None):
+
+    name = directory[:-1].rpartition('/')[2]
+    try:
+        ignore_data = read_file(directory + '.gitignore')
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        exclude_oid = NULL_SHA1
+    else:
+        position = tracked.get(directory + '.gitignore')
+        exclude_oid = get_exclude_oid(
+            ignore_data, None if position is None else entries.sha1(position))
+        patterns += parse_ignore_data(ignore_data, directory)
+
+    if cached is not None and cached.exclude_oid != exclude_oid:
+        # changed ignore rules invalidate everything below this directory
+        cached = None
+    children = {d.name: d for d in cached.dirs} if cached else {}
+    if (cached is not None and cached.valid and touched_dirs is not None and
+            directory not in touched_dirs):
+        # the monitor saw no changes in this directory since the last scan
+        unchanged = True
+    else:
+        try:
+            stat_data = get_stat_data(os.stat(directory or '.'))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return ([], [], [], UntrackedDir(name, False, False, None,
+                                             exclude_oid, [], []))
+        unchanged = (cached is not None and cached.valid and
+                     stat_data_is_clean(cached.stat_data, stat_data,
+                                        index_mtime))
+    if unchanged:
+        subdirs = [(directory + d.name + '/', patterns, d)
+                   for d in cached.dirs]
+        untracked = [directory + n for n in cached.untracked]
+        return ([], untracked, subdirs, cached._replace(dirs=[]))
+
+    files, dirs = classify_entries(directory, list_directory(directory),
+                                   patterns)
+    untracked = sorted(p for p, _ in files if p not in tracked)
+    node = UntrackedDir(name, True, False, stat_data, exclude_oid,
+                        [p[len(directory):] for p in untracked], [])
+    subdirs = [(d, patterns, children.get(d[len(directory):-1]))
+               for d, _ in dirs]
+    return (files, untracked, subdirs, node)
+
+
+def scan_worktree_cached(jobs, patterns, cached, entries, tracked,
+                         index_mtime, touched_dirs=None):
+
+    jobs = jobs or os.cpu_count() or 1
+    files = {}
+    untracked = []
+    root = None
+    pending = [('', patterns, cached, None)]
+
+    def scan(item):
+        directory, patterns, cached, _ = item
+        return scan_directory_cached(directory, patterns, cached, entries,
+                                     tracked, index_mtime, touched_dirs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending:
+            if jobs == 1 or len(pending) == 1:
+                scans = [scan(item) for item in pending]
+            else:
+                scans = executor.map(scan, pending)
+            next_pending = []
+            for item, (dir_files, dir_untracked, subdirs, node) in zip(
+                    pending, scans):
+                files.update(dir_files)
+                untracked.extend(dir_untracked)
+                parent = item[3]
+                if parent is None:
+                    root = node
+                else:
+                    parent.dirs.append(node)
+                next_pending.extend(subdir + (node,) for subdir in subdirs)
+            pending = next_pending
+    return (files, untracked, root)
+
+
+def load_inotify():
+
+    if not sys.platform.startswith('linux'):
+        raise ValueError('fsmonitor requires Linux inotify')
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def recv_all(sock):
+
+    chunks = []
+    while True:
+        chunk = sock.recv(PACK_CHUNK_SIZE)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def run_fsmonitor():
+
+    libc = load_inotify()
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    daemon_id = '{}.{}'.format(os.getpid(), time.time_ns())
+    exclude_patterns = get_exclude_patterns()
+    watches = {}
+    # ignored directories are not watched, so they are reported as changed
+    # in every answer and anything tracked below them is always checked
+    unwatched = set()
+    changes = {}
+    seq = 0
+    floor = 0
+    exhausted = False
+
+    def watch_tree(directory, patterns):
+        nonlocal exhausted
+        paths = []
+        pending = [(directory, patterns)]
+        while pending and not exhausted:
+            directory, patterns = pending.pop()
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory or '.'),
+                                        FSMONITOR_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                if error == errno.ENOSPC:
+                    # out of watches: only a full scan can be trusted now
+                    exhausted = True
+                    break
+                raise OSError(error, 'inotify_add_watch failed', directory)
+            watches[wd] = directory
+            entries = list_directory(directory)
+            if any(entry.name == '.gitignore' for entry in entries):
+                patterns += read_ignore_file(directory + '.gitignore',
+                                             directory)
+            for entry in entries:
+                path = directory + entry.name
+                if entry.name == '.git':
+                    continue
+                paths.append(path)
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if is_ignored(patterns, path, True):
+                    unwatched.add(path)
+                else:
+                    pending.append((path + '/', patterns))
+        return paths
+
+    def watch_new_tree(directory):
+        patterns = get_directory_patterns(directory, exclude_patterns)
+        if patterns is None:
+            unwatched.add(directory[:-1])
+            return []
+        return watch_tree(directory, patterns)
+
+    def unwatch_tree(directory):
+        for wd, path in list(watches.items()):
+            if path.startswith(directory):
+                libc.inotify_rm_watch(fd, wd)
+                del watches[wd]
+        unwatched.difference_update(
+            [p for p in unwatched if (p + '/').startswith(directory)])
+
+    def read_events():
+        nonlocal seq, floor
+        while True:
+            try:
+                data = os.read(fd, PACK_CHUNK_SIZE)
+            except BlockingIOError:
+                return True
+            seq += 1
+            i = 0
+            while i < len(data):
+                wd, mask, _, name_len = struct.unpack_from('iIII', data, i)
+                i += 16 + name_len
+                name = os.fsdecode(data[i - name_len:i].rstrip(b'\x00'))
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, so every token handed out is stale
+                    changes.clear()
+                    floor = seq
+                    continue
+                if mask & IN_IGNORED:
+                    watches.pop(wd, None)
+                    continue
+                directory = watches.get(wd)
+                if directory is None:
+                    continue
+                if not name:
+                    if directory == '' and mask & (IN_DELETE_SELF |
+                                                   IN_MOVE_SELF):
+                        return False
+                    continue
+                path = directory + name
+                if path == '.git':
+                    continue
+                changes[path] = seq
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    for child in watch_new_tree(path + '/'):
+                        changes[child] = seq
+                elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                    unwatch_tree(path + '/')
+            if len(changes) > FSMONITOR_MAX_CHANGES:
+                changes.clear()
+                floor = seq
+
+    def answer(request):
+        token_id, _, token_seq = request.decode(
+            errors='replace').rpartition(':')
+        paths = ['/']
+        if not exhausted and token_id == daemon_id and \
+                token_seq.isdigit() and int(token_seq) >= floor:
+            since = int(token_seq)
+            paths = [path for path, path_seq in changes.items()
+                     if path_seq > since]
+            paths.extend(unwatched)
+        new_token = '{}:{}'.format(daemon_id, seq)
+        return b''.join(os.fsencode(p) + b'\x00' for p in [new_token] + paths)
+
+    watch_tree('', exclude_patterns)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.unlink(FSMONITOR_SOCKET)
+    except FileNotFoundError:
+        pass
+    server.bind(FSMONITOR_SOCKET)
+    server.listen()
+    try:
+        running = True
+        while running:
+            readable, _, _ = select.select([fd, server], [], [])
+            if fd in readable:
+                running = read_events()
+            if server not in readable:
+                continue
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    conn.settimeout(FSMONITOR_TIMEOUT)
+                    request = recv_all(conn)
+                    if request == b'quit':
+                        running = False
+                        conn.sendall(b'\x00')
+                    elif request.startswith(b'query '):
+                        # drain events queued before the query was sent
+                        running = read_events()
+                        conn.sendall(answer(request[6:]))
+                except OSError:
+                    pass
+    finally:
+        server.close()
+        os.unlink(FSMONITOR_SOCKET)
+        os.close(fd)
+
+
+def send_fsmonitor_request(request):
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(FSMONITOR_TIMEOUT)
+            sock.connect(FSMONITOR_SOCKET)
+            sock.sendall(request)
+            sock.shutdown(socket.SHUT_WR)
+            return recv_all(sock)
+    except OSError:
+        return None
+
+
+def start_fsmonitor():
+
+    load_inotify()
+    if send_fsmonitor_request(b'query ') is not None:
+        raise ValueError('fsmonitor is already running')
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        null_fd = os.open(os.devnull, os.O_RDWR)
+        for std_fd in range(3):
+            os.dup2(null_fd, std_fd)
+        try:
+            run_fsmonitor()
+        finally:
+            os._exit(0)
+    deadline = time.monotonic() + FSMONITOR_TIMEOUT
+    while send_fsmonitor_request(b'query ') is None:
+        if time.monotonic() > deadline or os.waitpid(pid, os.WNOHANG)[0]:
+            raise ValueError('fsmonitor failed to start')
+        time.sleep(0.05)
+    return pid
+
+
+def stop_fsmonitor():
+
+    if send_fsmonitor_request(b'quit') is None:
+        raise ValueError('fsmonitor is not running')
+
+
+def query_fsmonitor(token):
+
+    response = send_fsmonitor_request(b'query ' + token)
+    if not response:
+        return None
+    fields = [os.fsdecode(f) for f in response.split(b'\x00')[:-1]]
+    paths = set(fields[1:])
+    return (os.fsencode(fields[0]), None if '/' in paths else paths)
+
+
+def parse_fsmonitor(data, entries):
+
+    version, = struct.unpack('!L', data[:4])
+    if version != 2:
+        # e.g. git's hook version 1; dropping it just means a full check
+        return None
+    end = data.index(b'\x00', 4)
+    positions, _ = decode_ewah(data, end + 5)
+    return (data[4:end], {entries.path(k) for k in positions
+                          if k < len(entries)})
+
+
+def encode_fsmonitor(token, entries, dirty):
+
+    bitmap = encode_ewah(k for k, path in enumerate(entries.paths())
+                         if path in dirty)
+    return (struct.pack('!L', 2) + token + b'\x00' +
+            struct.pack('!L', len(bitmap)) + bitmap)
+
+
+def fsmonitor_touched(path, changes):
+
+    if path in changes:
+        return True
+    i = path.find('/')
+    while i >= 0:
+        if path[:i] in changes:
+            return True
+        i = path.find('/', i + 1)
+    return False
+
+
+def get_touched_dirs(changes):
+
+    dirs = set()
+    for path in changes:
+        parent, sep, _ = path.rpartition('/')
+        dirs.add(parent + sep)
+        dirs.add(path + '/')
+    return dirs
+
+
+def get_status(jobs=None, pathspecs=()):
+
+    pathspecs = [parse_pathspec(p) for p in pathspecs]
+    entries, extensions = read_index_file()
+    new_extensions = dict(extensions)
+    paths = entries.paths()
+    positions = {paths[k]: k
+                 for k in match_index_pathspecs(entries, pathspecs)}
+    entry_paths = positions.keys()
+    index_mtime = get_index_mtime()
+    patterns = get_exclude_patterns()
+
+    # a partial walk can neither refresh the untracked cache nor vouch for
+    # a new fsmonitor token, so with pathspecs both are left as they are
+    fsmonitor = None
+    if get_config_bool('core.fsmonitor') and not pathspecs:
+        token, dirty = b'', set()
+        if b'FSMN' in extensions:
+            token, dirty = (parse_fsmonitor(extensions[b'FSMN'], entries) or
+                            (token, dirty))
+        fsmonitor = query_fsmonitor(token)
+    elif not pathspecs:
+        new_extensions.pop(b'FSMN', None)
+    if fsmonitor is not None and fsmonitor[1] is not None:
+        touched_dirs = get_touched_dirs(fsmonitor[1])
+        assumed_clean = {p for p in entry_paths if p not in dirty and
+                         not fsmonitor_touched(p, fsmonitor[1])}
+    else:
+        # no monitor, or it cannot vouch for the token: check everything
+        touched_dirs = None
+        assumed_clean = set()
+
+    untracked_cache = get_config('core.untrackedCache', 'keep').lower()
+    if pathspecs:
+        files = scan_pathspecs(jobs, patterns, pathspecs)
+        new = files.keys() - entry_paths
+    elif untracked_cache in ('true', 'yes', 'on', '1') or (
+            untracked_cache == 'keep' and b'UNTR' in extensions):
+        cache = load_untracked_cache(extensions.get(b'UNTR'))
+        files, untracked, root = scan_worktree_cached(
+            jobs, patterns, cache.root if cache else None, entries, positions,
+            index_mtime, touched_dirs)
+        new_extensions[b'UNTR'] = encode_untracked_cache(
+            new_untracked_cache(root))
+        new = set(untracked) - entry_paths
+    else:
+        files = scan_worktree(jobs, patterns)
+        new = files.keys() - entry_paths
+        new_extensions.pop(b'UNTR', None)
+    deleted = set()
+    for path in entry_paths - files.keys() - assumed_clean:
+        # tracked files are checked even when ignore rules hide them
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        if st is None or stat.S_ISDIR(st.st_mode):
+            deleted.add(path)
         else:
-            print(entry.path)
-
-
-def get_status():
-
-    paths = set()
-    for root, dirs, files in os.walk('.'):
-        dirs[:] = [d for d in dirs if d != '.git']
-        for file in files:
-            path = os.path.join(root, file)
-            path = path.replace('\\', '/')
-            if path.startswith('./'):
-                path = path[2:]
-            paths.add(path)
-    entries_by_path = {e.path: e for e in read_index()}
-    entry_paths = set(entries_by_path)
-    changed = {p for p in (paths & entry_paths)
-               if hash_object(read_file(p), 'blob', write=False) !=
-               entries_by_path[p].sha1.hex()}
-    new = paths - entry_paths
-    deleted = entry_paths - paths
+            files[path] = st
+    candidates = [p for p in sorted(entry_paths - deleted - assumed_clean)
+                  if not index_entry_is_clean(entries, positions[p], files[p],
+                                              index_mtime)]
+    hashes = hash_files(candidates, write=False, jobs=jobs)
+    changed = {p for p, sha1 in zip(candidates, hashes)
+               if sha1 != entries.sha1(positions[p]).hex()}
+
+    if fsmonitor is not None:
+        new_extensions[b'FSMN'] = encode_fsmonitor(
+            fsmonitor[0], entries, deleted.union(candidates))
+    if new_extensions != extensions:
+        write_index(smudge_racy_entries(entries, index_mtime), new_extensions)
 
     return (sorted(changed), sorted(new), sorted(deleted))
 
 
-def status():
+def status(jobs=None, pathspecs=(), null_terminated=False):
 
-    changed, new, deleted = get_status()
-    if changed:
-        print('changed files:')
-        for path in changed:
-            print('   ', path)
-    if new:
-        print('new files:')
-        for path in new:
-            print('   ', path)
-    if deleted:
-        print('deleted files:')
-        for path in deleted:
-            print('   ', path)
+    changed, new, deleted = get_status(jobs, pathspecs)
+    lines = []
+    if null_terminated:
+        # porcelain style: tracked changes in path order, then untracked
+        tracked = [(path, ' M') for path in changed]
+        tracked.extend((path, ' D') for path in deleted)
+        for path, code in sorted(tracked):
+            lines.append(f"""{code} {path}\x00""")
+        lines.extend(f"""?? {path}\x00""" for path in new)
+    else:
+        for title, paths in [('changed', changed), ('new', new),
+                             ('deleted', deleted)]:
+            if paths:
+                lines.append(f"""{title} files:\n""")
+                lines.extend(f"""    {path}\n""" for path in paths)
+    out = sys.stdout.buffer
+    out.write(''.join(lines).encode())
+    out.flush()
 
 
-def diff():
+def diff(jobs=None, pathspecs=()):
 
-    changed, _, _ = get_status()
-    entries_by_path = {e.path: e for e in read_index()}
+    changed, _, _ = get_status(jobs, pathspecs)
+    entries = read_index()
+    paths = entries.paths()
     for i, path in enumerate(changed):
-        sha1 = entries_by_path[path].sha1.hex()
+        sha1 = entries.sha1(bisect.bisect_left(paths, path)).hex()
         obj_type, data = read_object(sha1)
         assert obj_type == 'blob'
         index_lines = data.decode().splitlines()
@@ -232,60 +2368,413 @@ def diff():
             print('-' * 70)
 
 
-def write_index(entries):
+def common_prefix_length(a, b):
 
-    packed_entries = []
-    for entry in entries:
-        entry_head = struct.pack('!LLLLLLLLLL20sH',
-                                 entry.ctime_s, entry.ctime_n, entry.mtime_s,
-                                 entry.mtime_n, entry.dev, entry.ino,
-                                 entry.mode, entry.uid, entry.gid,
-                                 entry.size, entry.sha1, entry.flags)
+    n = min(len(a), len(b))
+    # the highest differing byte of the XOR marks the end of the prefix
+    diff = int.from_bytes(a[:n], 'big') ^ int.from_bytes(b[:n], 'big')
+    return n - (diff.bit_length() + 7) // 8
 
-        path = entry.path.encode()
-        length = ((62 + len(path) + 8) // 8) * 8
-        packed_entry = entry_head + path + b'\x00' * (length - 62 - len(path))
-        packed_entries.append(packed_entry)
 
-    header = struct.pack('!4sLL', b'DIRC', 2, len(entries))
-    all_data = header + b''.join(packed_entries)
-    digest = hashlib.sha1(all_data).digest()
-    write_file(os.path.join('.git', 'index'), all_data + digest)
+def get_index_version():
 
+    version = get_config('index.version')
+    if version is None:
+        try:
+            with open(os.path.join('.git', 'index'), 'rb') as f:
+                header = f.read(12)
+            version = struct.unpack('!4sLL', header)[1]
+        except (FileNotFoundError, struct.error):
+            version = 2
+    version = int(version)
+    if version not in INDEX_VERSIONS:
+        raise ValueError('unsupported index version {}'.format(version))
+    return version
+
+
+def encode_index(entries, extensions=None, version=2, skip_hash=False):
+
+    # entries are appended to one buffer straight from the packed heads
+    # and path data, without building per-entry objects
+    heads = memoryview(entries.heads())
+    offsets = entries.path_offsets()
+    path_data = memoryview(entries.path_data)
+    entry_offsets = zip(range(0, len(heads), 62), offsets,
+                        itertools.islice(offsets, 1, None))
+    all_data = bytearray(struct.pack('!4sLL', b'DIRC', version, len(entries)))
+    if version == 4:
+        previous_path = b''
+        for h, a, b in entry_offsets:
+            path = path_data[a:b].tobytes()
+            common = common_prefix_length(previous_path, path)
+            strip = len(previous_path) - common
+            all_data += heads[h:h + 62]
+            all_data += (bytes((strip,)) if strip < 0x80
+                         else encode_varint(strip))
+            all_data += path_data[a + common:b]
+            all_data += b'\x00'
+            previous_path = path
+    else:
+        padding = INDEX_PADDING
+        for h, a, b in entry_offsets:
+            all_data += heads[h:h + 62]
+            all_data += path_data[a:b]
+            all_data += padding[8 - (62 + b - a) % 8]
+
+    for signature in INDEX_EXTENSIONS:
+        if extensions and signature in extensions:
+            data = extensions[signature]
+            all_data += struct.pack('!4sL', signature, len(data))
+            all_data += data
+
+    all_data += NULL_SHA1 if skip_hash else hashlib.sha1(all_data).digest()
+    return bytes(all_data)
+
+
+def write_shared_index(entries, version):
+
+    data = encode_index(entries, version=version)
+    sha1 = data[-20:].hex()
+    path = shared_index_path(sha1)
+    if not os.path.exists(path):
+        write_file_atomic(path, data)
+    _shared_index.clear()
+    _shared_index[sha1] = entries
+
+    expire = time.time() - SHARED_INDEX_EXPIRE
+    for name in os.listdir('.git'):
+        other_path = os.path.join('.git', name)
+        if (name.startswith('sharedindex.') and other_path != path and
+                os.stat(other_path).st_mtime < expire):
+            os.remove(other_path)
+    return sha1
 
-def add(paths):
 
-    paths = [p.replace('\\', '/') for p in paths]
-    all_entries = read_index()
-    entries = [e for e in all_entries if e.path not in paths]
+def split_index_entries(entries, link, version):
 
-    for path in paths:
-        sha1 = hash_object(read_file(path), 'blob')
-        st = os.stat(path)
-        flags = len(path.encode())
+    base_sha1 = link[:20].hex() if link else None
+    try:
+        base = read_shared_index(base_sha1) if base_sha1 else None
+    except FileNotFoundError:
+        base = None
+    if base is None:
+        return (write_shared_index(entries, version), [], [], [])
+
+    # both indexes are sorted, so walk them side by side
+    base_paths = base.paths()
+    base_heads = base.heads()
+    paths = entries.paths()
+    heads = entries.heads()
+    kept = bytearray(len(base))
+    replaced = []
+    added = []
+    i = 0
+    for k, path in enumerate(paths):
+        while i < len(base_paths) and base_paths[i] < path:
+            i += 1
+        if i < len(base_paths) and base_paths[i] == path:
+            kept[i] = 1
+            if heads[62 * k:62 * k + 62] != base_heads[62 * i:62 * i + 62]:
+                entry = entries[k]
+                replaced.append((i, entry._replace(
+                    flags=entry.flags & ~0xfff, path='')))
+            i += 1
+        else:
+            added.append(entries[k])
+    if (len(replaced) + len(added)) * 100 > \
+            SPLIT_INDEX_MAX_PERCENT_CHANGE * len(entries):
+        # too much has diverged from the base: start a new one
+        return (write_shared_index(entries, version), [], [], [])
+
+    os.utime(shared_index_path(base_sha1))
+    deleted = [k for k, present in enumerate(kept) if not present]
+    return (base_sha1, deleted, replaced, added)
+
+
+def write_index(entries, extensions=None):
+
+    global _index_cache
+    if not isinstance(entries, Index):
+        entries = Index.from_entries(entries)
+    version = get_index_version()
+    extensions = dict(extensions or {})
+    link = extensions.pop(b'link', None)
+    file_entries = entries
+    if get_config_bool('core.splitIndex', link is not None):
+        base_sha1, deleted, replaced, added = split_index_entries(
+            entries, link, version)
+        extensions[b'link'] = (bytes.fromhex(base_sha1) +
+                               encode_ewah(deleted) +
+                               encode_ewah(k for k, _ in replaced))
+        file_entries = Index.from_entries([e for _, e in replaced] + added)
+    data = encode_index(file_entries, extensions, version,
+                        skip_hash=get_config_bool('index.skipHash'))
+
+    fd, temp_path = tempfile.mkstemp(prefix='tmp_index_', dir='.git')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.flush()
+        st = os.fstat(f.fileno())
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, os.path.join('.git', 'index'))
+    # the rename keeps the inode, size and mtime, so this process can
+    # keep using what it just wrote without reading it back
+    _index_cache = ((st.st_ino, st.st_size, st.st_mtime_ns), entries,
+                    extensions)
+
+
+def add(paths, all_files=False, jobs=None):
+
+    if all_files and not paths:
+        paths = ['.']
+    pathspecs = [parse_pathspec(p) for p in paths]
+    entries, extensions = read_index_file()
+    entry_paths = entries.paths()
+    index_mtime = get_index_mtime()
+    patterns = get_exclude_patterns()
+
+    # collect the stat data of every file the pathspecs cover; None marks
+    # a tracked file that is gone and whose entry is to be removed
+    files = scan_pathspecs(jobs, patterns, pathspecs, ignored_files=True)
+    for k in match_index_pathspecs(entries, pathspecs):
+        path = entry_paths[k]
+        if path in files:
+            continue
+        # tracked files are updated even when ignore rules hide them
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        files[path] = None if st is None or stat.S_ISDIR(st.st_mode) else st
+    for pathspec, path in zip(pathspecs, paths):
+        matches = pathspec_matcher([pathspec])
+        start, end = pathspec_range(entry_paths, pathspec)
+        if pathspec.regex is None:
+            found = os.path.exists(pathspec.path or '.')
+        else:
+            found = any(map(matches, files))
+        if not found and not any(
+                map(matches, itertools.islice(entry_paths, start, end))):
+            raise ValueError(f"""pathspec '{path}' did not match any files""")
+    # like git, naming an ignored directory is an error, but tracked files
+    # below it are still updated first
+    ignored = [pathspec.path for pathspec in pathspecs
+               if pathspec.regex is None and pathspec.path and
+               os.path.isdir(pathspec.path) and
+               get_directory_patterns(pathspec.path + '/', patterns) is None]
+
+    updates = {}
+    changed_dirs = []
+    changed_trees = []
+    to_hash = []
+    for path, st in sorted(files.items(), key=operator.itemgetter(0)):
+        position = bisect.bisect_left(entry_paths, path)
+        if position == len(entries) or entry_paths[position] != path:
+            position = None
+        if st is None:
+            updates[path] = None
+            changed_dirs.append(path)
+            changed_trees.append(path)
+        elif position is None or not index_entry_is_clean(
+                entries, position, st, index_mtime):
+            to_hash.append((path, st, position))
+    hashes = hash_files([path for path, _, _ in to_hash], jobs=jobs)
+    for (path, st, position), sha1 in zip(to_hash, hashes):
+        updates[path] = index_entry_from_stat(path, sha1, st)
+        if position is None:
+            changed_dirs.append(path)
+        if (position is None or entries.sha1(position).hex() != sha1 or
+                entries.columns['mode'][position] != st.st_mode):
+            changed_trees.append(path)
+    if not updates:
+        raise_ignored_paths(ignored)
+        return
 
-        assert flags < (1 << 12)
+    # only adding or removing paths changes what is untracked
+    if b'UNTR' in extensions:
+        cache = parse_untracked_cache(extensions[b'UNTR'])
+        root = cache.root
+        for path in changed_dirs:
+            if root is not None:
+                root = invalidate_untracked_dir(root, path.split('/')[:-1])
+        extensions[b'UNTR'] = encode_untracked_cache(cache._replace(root=root))
+    tree = parse_cache_tree(extensions.get(b'TREE', b''))
+    if tree is not None:
+        for path in changed_trees:
+            tree = invalidate_cache_tree(tree, path.split('/')[:-1])
+        extensions[b'TREE'] = encode_cache_tree(tree)
+
+    new_entries = update_index_entries(
+        smudge_racy_entries(entries, index_mtime), updates)
+    fsmonitor = None
+    if b'FSMN' in extensions:
+        fsmonitor = parse_fsmonitor(extensions[b'FSMN'], entries)
+    if fsmonitor is not None:
+        token, dirty = fsmonitor
+        extensions[b'FSMN'] = encode_fsmonitor(token, new_entries,
+                                               dirty.union(updates))
+    else:
+        extensions.pop(b'FSMN', None)
+    write_index(new_entries, extensions)
+    raise_ignored_paths(ignored)
 
-        entry = IndexEntry(
-            int(st.st_ctime), 0, int(st.st_mtime), 0, st.st_dev,
-            st.st_ino, st.st_mode, st.st_uid, st.st_gid, st.st_size,
-            bytes.fromhex(sha1), flags, path)
-        entries.append(entry)
 
-    entries.sort(key=operator.attrgetter('path'))
-    write_index(entries)
+def raise_ignored_paths(paths):
 
+    if paths:
+        raise ValueError('The following paths are ignored by one of your '
+                         '.gitignore files:\n' + '\n'.join(paths))
 
-def write_tree():
+
+def refresh_index():
+
+    index_mtime = get_index_mtime()
+    entries, extensions = read_index_file()
+    refreshed = {}
+    modified = []
+    for k, path in enumerate(entries.paths()):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            modified.append(path)
+            continue
+        if index_entry_is_clean(entries, k, st, index_mtime):
+            continue
+        sha1 = entries.sha1(k).hex()
+        if hash_file(path, write=False) == sha1:
+            refreshed[path] = index_entry_from_stat(path, sha1, st)
+        else:
+            modified.append(path)
+
+    if refreshed:
+        entries = smudge_racy_entries(entries, index_mtime)
+        write_index(update_index_entries(entries, refreshed), extensions)
+    return (len(refreshed), modified)
+
+
+def parse_cache_tree(data):
+
+    def parse(i):
+        end = data.index(b'\x00', i)
+        name = data[i:end].decode()
+        newline = data.index(b'\n', end)
+        entry_count, num_subtrees = map(int, data[end + 1:newline].split())
+        i = newline + 1
+        sha1 = None
+        if entry_count >= 0:
+            sha1 = data[i:i + 20]
+            i += 20
+        subtrees = []
+        for _ in range(num_subtrees):
+            subtree, i = parse(i)
+            subtrees.append(subtree)
+        return (CacheTree(name, entry_count, sha1, subtrees), i)
+
+    return parse(0)[0] if data else None
+
+
+def encode_cache_tree(tree):
+
+    result = []
+
+    def encode(tree):
+        result.append('{}\x00{} {}\n'.format(
+            tree.name, tree.entry_count, len(tree.subtrees)).encode())
+        if tree.entry_count >= 0:
+            result.append(tree.sha1)
+        # like git, order subtrees by name length and then by name
+        for subtree in sorted(tree.subtrees, key=lambda t: (
+                len(t.name.encode()), t.name.encode())):
+            encode(subtree)
+
+    encode(tree)
+    return b''.join(result)
+
+
+def invalidate_cache_tree(tree, names):
+
+    subtrees = tree.subtrees
+    if names:
+        subtrees = [invalidate_cache_tree(t, names[1:])
+                    if t.name == names[0] else t for t in subtrees]
+    return tree._replace(entry_count=-1, sha1=None, subtrees=subtrees)
+
+
+def build_cache_tree(entries, paths, start, end, prefix, cached):
+
+    if (cached is not None and cached.entry_count == end - start and
+            object_exists(cached.sha1.hex())):
+        return cached
+
+    cached_subtrees = {t.name: t for t in cached.subtrees} if cached else {}
+    modes = entries.columns['mode']
     tree_entries = []
-    for entry in read_index():
-        assert '/' not in entry.path, \
-            'currently only supports a single, top-level directory'
-        mode_path = '{:o} {}'.format(entry.mode, entry.path).encode()
-        tree_entry = mode_path + b'\x00' + entry.sha1
-        tree_entries.append(tree_entry)
+    subtrees = []
+    i = start
+    while i < end:
+        path = paths[i]
+        slash = path.find('/', len(prefix))
+        if slash < 0:
+            tree_entries.append('{:o} {}'.format(
+                modes[i], path[len(prefix):]).encode() + b'\x00' +
+                entries.sha1(i))
+            i += 1
+            continue
+        name = path[len(prefix):slash]
+        # '0' sorts right after '/', so this finds the end of the directory
+        subtree_end = bisect.bisect_left(paths, path[:slash] + '0', i, end)
+        subtree = build_cache_tree(entries, paths, i, subtree_end,
+                                   path[:slash + 1],
+                                   cached_subtrees.get(name))
+        subtrees.append(subtree)
+        tree_entries.append(b'40000 ' + name.encode() + b'\x00' +
+                            subtree.sha1)
+        i = subtree_end
+
+    sha1 = hash_object(b''.join(tree_entries), 'tree')
+    name = prefix[:-1].rpartition('/')[2]
+    return CacheTree(name, end - start, bytes.fromhex(sha1), subtrees)
 
-    return hash_object(b''.join(tree_entries), 'tree')
+
+def write_tree():
+
+    index_mtime = get_index_mtime()
+    entries, extensions = read_index_file()
+    cached = parse_cache_tree(extensions.get(b'TREE', b''))
+    paths = entries.paths()
+    tree = build_cache_tree(entries, paths, 0, len(entries), '', cached)
+    if tree is not cached:
+        extensions = dict(extensions)
+        extensions[b'TREE'] = encode_cache_tree(tree)
+        write_index(smudge_racy_entries(entries, index_mtime), extensions)
+    return tree.sha1.hex()
+
+
+def read_packed_refs():
+    refs = {}
+    try:
+        data = read_file(os.path.join('.git', 'packed-refs')).decode()
+    except FileNotFoundError:
+        return refs
+    for line in data.splitlines():
+        # skip the header and the peeled values of annotated tags
+        if line and not line.startswith(('#', '^')):
+            sha1, name = line.split(' ', 1)
+            refs[name] = sha1
+    return refs
+
+
+def read_refs():
+    # loose refs take precedence over packed ones, as in git
+    refs = read_packed_refs()
+    for root, _, files in os.walk(os.path.join('.git', 'refs')):
+        for name in files:
+            path = os.path.join(root, name)
+            value = read_file(path).decode().strip()
+            if not value.startswith('ref: '):
+                ref = os.path.relpath(path, '.git').replace(os.sep, '/')
+                refs[ref] = value
+    return refs
 
 
 def get_local_main_hash():
@@ -293,7 +2782,7 @@ def get_local_main_hash():
     try:
         return read_file(main_path).decode().strip()
     except FileNotFoundError:
-        return None
+        return read_packed_refs().get('refs/heads/main')
 
 
 def commit(message, author=None):
@@ -395,41 +2884,49 @@ def read_tree(sha1=None, data=None):
     return entries
 
 
-def find_tree_objects(tree_sha1):
-    objects = {tree_sha1}
+def find_tree_objects(tree_sha1, names=None, base='', objects=None):
+    if objects is None:
+        objects = set()
+    objects.add(tree_sha1)
     for mode, path, sha1 in read_tree(sha1=tree_sha1):
+        if names is not None:
+            names.setdefault(sha1, base + path)
         if stat.S_ISDIR(mode):
-            objects.update(find_tree_objects(sha1))
+            if sha1 not in objects:
+                find_tree_objects(sha1, names, base + path + '/', objects)
         else:
             objects.add(sha1)
     return objects
 
 
-def find_commit_objects(commit_sha1):
-    objects = {commit_sha1}
-    obj_type, commit = read_object(commit_sha1)
-    assert obj_type == 'commit'
-    lines = commit.decode().splitlines()
-    tree = next(lr[5:45] for lr in lines if lr.startswith('tree '))
-    objects.update(find_tree_objects(tree))
-    parents = (lr[7:47] for lr in lines if lr.startswith('parent '))
-    for parent in parents:
-        objects.update(find_commit_objects(parent))
+def find_commit_objects(commit_sha1, names=None, objects=None):
+    if objects is None:
+        objects = set()
+    pending = [commit_sha1]
+    while pending:
+        sha1 = pending.pop()
+        if sha1 in objects:
+            continue
+        objects.add(sha1)
+        obj_type, commit = read_object(sha1)
+        assert obj_type == 'commit'
+        lines = commit.decode().splitlines()
+        tree = next(lr[5:45] for lr in lines if lr.startswith('tree '))
+        if tree not in objects:
+            find_tree_objects(tree, names, objects=objects)
+        pending.extend(lr[7:47] for lr in lines if lr.startswith('parent '))
     return objects
 
 
-def find_missing_objects(local_sha1, remote_sha1):
-    local_objects = find_commit_objects(local_sha1)
+def find_missing_objects(local_sha1, remote_sha1, names=None):
+    local_objects = find_commit_objects(local_sha1, names)
     if remote_sha1 is None:
         return local_objects
     remote_objects = find_commit_objects(remote_sha1)
     return local_objects - remote_objects
 
 
-def encode_pack_object(obj):
-    obj_type, data = read_object(obj)
-    type_num = ObjectType[obj_type].value
-    size = len(data)
+def encode_pack_header(type_num, size):
     byte = (type_num << 4) | (size & 0x0f)
     size >>= 4
     header = []
@@ -438,32 +2935,329 @@ def encode_pack_object(obj):
         byte = size & 0x7f
         size >>= 7
     header.append(byte)
-    return bytes(header) + zlib.compress(data)
+    return bytes(header)
+
+
+def encode_delta_size(size):
+    result = []
+    while True:
+        byte = size & 0x7f
+        size >>= 7
+        if not size:
+            result.append(byte)
+            return bytes(result)
+        result.append(byte | 0x80)
+
+
+def encode_delta_copy(offset, size):
+    command = 0x80
+    args = []
+    for i in range(4):
+        byte = (offset >> (8 * i)) & 0xff
+        if byte:
+            command |= 1 << i
+            args.append(byte)
+    for i in range(3):
+        byte = (size >> (8 * i)) & 0xff
+        if byte:
+            command |= 0x10 << i
+            args.append(byte)
+    return bytes([command] + args)
+
+
+def encode_delta_insert(data):
+    result = []
+    for i in range(0, len(data), DELTA_MAX_INSERT):
+        chunk = data[i:i + DELTA_MAX_INSERT]
+        result.append(bytes([len(chunk)]))
+        result.append(chunk)
+    return b''.join(result)
+
 
+def create_delta(base, target, max_size=None):
+    if len(base) < DELTA_BLOCK_SIZE or len(base) > 0xffffffff:
+        return None
 
-def create_pack(objects):
+    index = {}
+    for i in range(0, len(base) - DELTA_BLOCK_SIZE + 1, DELTA_BLOCK_SIZE):
+        index.setdefault(base[i:i + DELTA_BLOCK_SIZE], i)
+
+    delta = bytearray(encode_delta_size(len(base)))
+    delta += encode_delta_size(len(target))
+    insert_start = 0
+    i = 0
+    while i <= len(target) - DELTA_BLOCK_SIZE:
+        base_offset = index.get(target[i:i + DELTA_BLOCK_SIZE])
+        if base_offset is None:
+            i += 1
+            # the pending literal bytes alone already exceed the budget
+            if max_size is not None and len(delta) + i - insert_start > max_size:
+                return None
+            continue
+
+        while (i > insert_start and base_offset > 0 and
+               target[i - 1] == base[base_offset - 1]):
+            i -= 1
+            base_offset -= 1
+        length = DELTA_BLOCK_SIZE
+        max_length = min(len(base) - base_offset, len(target) - i)
+        step = 4096
+        while step:
+            while (length + step <= max_length and
+                   target[i + length:i + length + step] ==
+                   base[base_offset + length:base_offset + length + step]):
+                length += step
+            step //= 8
+
+        delta += encode_delta_insert(target[insert_start:i])
+        for copied in range(0, length, DELTA_MAX_COPY):
+            delta += encode_delta_copy(base_offset + copied,
+                                       min(DELTA_MAX_COPY, length - copied))
+        i += length
+        insert_start = i
+        if max_size is not None and len(delta) > max_size:
+            return None
+
+    delta += encode_delta_insert(target[insert_start:])
+    if max_size is not None and len(delta) > max_size:
+        return None
+    return bytes(delta)
+
+
+def pack_name_hash(name):
+    hash_value = 0
+    for c in name.encode():
+        if c in b' \t\n\r\v\f':
+            continue
+        hash_value = ((hash_value >> 2) + (c << 24)) & 0xffffffff
+    return hash_value
+
+
+def build_pack(objects, names=None, window=DELTA_WINDOW, depth=DELTA_DEPTH,
+               window_memory=DELTA_WINDOW_MEMORY):
+    names = names or {}
+    sizes = {}
+    for obj in objects:
+        obj_type, size = read_object_header(obj)
+        sizes[obj] = (ObjectType[obj_type].value, size)
+    ordered = sorted(objects, key=lambda o: (
+        -sizes[o][0], -pack_name_hash(names.get(o, '')), -sizes[o][1], o))
+
+    big_file_threshold = get_config_size('core.bigFileThreshold',
+                                         DELTA_BIG_FILE_THRESHOLD)
     header = struct.pack('!4sLL', b'PACK', 2, len(objects))
-    body = b''.join(encode_pack_object(o) for o in sorted(objects))
-    contents = header + body
+    body = []
+    offset = len(header)
+    offsets = {}
+    depths = {}
+    index_entries = []
+    candidates = collections.deque()
+    candidates_size = 0
+    for obj in ordered:
+        obj_type, data = read_object(obj)
+        type_num = ObjectType[obj_type].value
+        best = None
+        # big objects are stored whole and never searched for deltas
+        big = len(data) > big_file_threshold
+        for base, base_type, base_data in candidates:
+            if big or base_type != type_num or depths[base] >= depth:
+                continue
+            if len(data) < len(base_data) // 32:
+                continue
+            if best is None:
+                max_size = len(data) // 2 - 20
+                max_size = max_size * (depth - depths[base]) // depth
+            else:
+                max_size = len(best[1]) - 1
+            # growth beyond the base must all be inserted literally
+            if max_size <= 0 or len(data) - len(base_data) >= max_size:
+                continue
+            delta = create_delta(base_data, data, max_size)
+            if delta is not None:
+                best = (base, delta)
+
+        offsets[obj] = offset
+        if best is None:
+            depths[obj] = 0
+            entry = (encode_pack_header(type_num, len(data)) +
+                     zlib.compress(data))
+        else:
+            base, delta = best
+            depths[obj] = depths[base] + 1
+            entry = (encode_pack_header(ObjectType.ofs_delta.value,
+                                        len(delta)) +
+                     encode_varint(offset - offsets[base]) +
+                     zlib.compress(delta))
+        body.append(entry)
+        index_entries.append((bytes.fromhex(obj), offset, zlib.crc32(entry)))
+        offset += len(entry)
+
+        if window > 0 and not big:
+            candidates.append((obj, type_num, data))
+            candidates_size += len(data)
+            while (len(candidates) > window or
+                   (window_memory and candidates_size > window_memory and
+                    len(candidates) > 1)):
+                candidates_size -= len(candidates.popleft()[2])
+
+    contents = header + b''.join(body)
     sha1 = hashlib.sha1(contents).digest()
     data = contents + sha1
+    return (data, index_entries)
+
+
+def create_pack(objects, names=None, window=DELTA_WINDOW, depth=DELTA_DEPTH,
+                window_memory=DELTA_WINDOW_MEMORY):
+    data, _ = build_pack(objects, names=names, window=window, depth=depth,
+                         window_memory=window_memory)
     return data
 
 
-def push(git_url, username=None, password=None):
+def create_pack_index(index_entries, pack_sha1):
+    index_entries = sorted(index_entries)
+    fanout = [0] * 256
+    for name, _, _ in index_entries:
+        fanout[name[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    offsets = []
+    large_offsets = []
+    for _, offset, _ in index_entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+    num_entries = len(index_entries)
+    contents = b''.join([
+        struct.pack('!4sL', b'\xfftOc', 2),
+        struct.pack('!256L', *fanout),
+        b''.join(name for name, _, _ in index_entries),
+        struct.pack(f"""!{num_entries}L""", *(c for _, _, c in index_entries)),
+        struct.pack(f"""!{num_entries}L""", *offsets),
+        struct.pack(f"""!{len(large_offsets)}Q""", *large_offsets),
+        pack_sha1,
+    ])
+    return contents + hashlib.sha1(contents).digest()
+
+
+def close_pack(name):
+    pack = _packs.pop(name)
+    for key in [k for k in _delta_base_cache if k[0] == pack.path]:
+        cache_delta_base_evict(key)
+    pack.index.close()
+    pack.data.close()
+
+
+def iter_loose_objects():
+    objects_dir = os.path.join('.git', 'objects')
+    for bucket in sorted(os.listdir(objects_dir)):
+        if len(bucket) != 2:
+            continue
+        for entry in os.scandir(os.path.join(objects_dir, bucket)):
+            if len(entry.name) == 38:
+                yield (bucket + entry.name, entry)
+
+
+def count_objects():
+    loose = [entry.stat().st_size for _, entry in iter_loose_objects()]
+    packs = [os.path.getsize(pack.path) + os.path.getsize(pack.path[:-5] + '.idx')
+             for pack in get_packs(rescan=True)]
+    return (len(loose), sum(loose), len(packs), sum(packs))
+
+
+def find_reachable_objects(names=None):
+    entries = read_index()
+    objects = {entries.sha1(k).hex() for k in range(len(entries))}
+    # every ref is a root, packed or loose, whatever it points at
+    for sha1 in read_refs().values():
+        obj_type, data = read_object(sha1)
+        while obj_type == 'tag':
+            objects.add(sha1)
+            sha1 = data[7:47].decode()
+            obj_type, data = read_object(sha1)
+        if obj_type == 'commit':
+            find_commit_objects(sha1, names, objects)
+        elif obj_type == 'tree':
+            find_tree_objects(sha1, names, objects=objects)
+        else:
+            objects.add(sha1)
+    return objects
+
+
+def repack(window=DELTA_WINDOW, depth=DELTA_DEPTH,
+           window_memory=DELTA_WINDOW_MEMORY, prune=True,
+           grace=PRUNE_GRACE_PERIOD):
+    if prune and get_local_main_hash() is None:
+        # without the main branch, reachability can't be trusted
+        raise ValueError('cannot resolve refs/heads/main, refusing to prune')
+    before = count_objects()
+    names = {}
+    reachable = find_reachable_objects(names)
+    old_packs = dict(_packs)
+
+    pack_dir = os.path.join('.git', 'objects', 'pack')
+    os.makedirs(pack_dir, exist_ok=True)
+    if reachable:
+        data, index_entries = build_pack(reachable, names=names,
+                                         window=window, depth=depth,
+                                         window_memory=window_memory)
+        pack_name = 'pack-' + data[-20:].hex()
+        # the .idx goes last: readers only look for packs through it
+        write_file_atomic(os.path.join(pack_dir, pack_name + '.pack'), data)
+        write_file_atomic(os.path.join(pack_dir, pack_name + '.idx'),
+                          create_pack_index(index_entries, data[-20:]))
+        old_packs.pop(pack_name, None)
+
+    if prune:
+        expire = time.time() - grace
+        for name, pack in old_packs.items():
+            mtime = os.stat(pack.path).st_mtime
+            if mtime < expire:
+                continue
+            for i in range(pack.num_objects):
+                sha1 = pack_object_name(pack, i).hex()
+                if sha1 not in reachable:
+                    # unreachable objects still within the grace period
+                    # are kept as loose objects with the pack's age
+                    obj_type, data = read_packed_object(
+                        pack, pack_object_offset(pack, i))
+                    write_loose_object(data, obj_type, mtime)
+        for name in old_packs:
+            close_pack(name)
+            for ext in ('.pack', '.idx'):
+                os.remove(os.path.join(pack_dir, name + ext))
+        for sha1, entry in list(iter_loose_objects()):
+            if (sha1 in reachable or
+                    entry.stat().st_mtime < expire):
+                os.remove(entry.path)
+        _loose_object_names.clear()
+
+    after = count_objects()
+    for label, counts in (('before', before), ('after', after)):
+        print('{}: {} loose object{} ({} bytes), {} pack{} ({} bytes)'.format(
+            label, counts[0], '' if counts[0] == 1 else 's', counts[1],
+            counts[2], '' if counts[2] == 1 else 's', counts[3]))
+
+
+def push(git_url, username=None, password=None, window=DELTA_WINDOW,
+         depth=DELTA_DEPTH, window_memory=DELTA_WINDOW_MEMORY):
     if username is None:
         username = os.environ['GIT_USERNAME']
     if password is None:
         password = os.environ['GIT_PASSWORD']
     remote_sha1 = get_remote_main_hash(git_url, username, password)
     local_sha1 = get_local_main_hash()
-    missing = find_missing_objects(local_sha1, remote_sha1)
+    names = {}
+    missing = find_missing_objects(local_sha1, remote_sha1, names)
     print('updating remote main from {} to {} ({} object{})'.format(
         remote_sha1 or 'no commits', local_sha1, len(missing),
         '' if len(missing) == 1 else 's'))
     lines = [
         f"""{remote_sha1 or ('0' * 40)} {local_sha1} refs/heads/main\x00 report-status""".encode()]
-    data = build_lines_data(lines) + create_pack(missing)
+    pack = create_pack(missing, names=names, window=window, depth=depth,
+                       window_memory=window_memory)
+    data = build_lines_data(lines) + pack
     url = git_url + '/git-receive-pack'
     response = http_request(url, username, password, data=data)
     lines = extract_lines(response)
@@ -484,16 +3278,31 @@ if __name__ == '__main__':
 
     sub_parser = sub_parsers.add_parser('add', help='add file(s) to index')
     sub_parser.add_argument(
-        'paths', nargs='+', metavar='path', help='path(s) of files to add')
+        'paths', nargs='*', metavar='pathspec',
+        help='files, directories or glob patterns to add')
+    sub_parser.add_argument('-A', '--all', action='store_true',
+                            help='add, modify and remove entries for the whole '
+                            'working tree')
+    sub_parser.add_argument('-j', '--jobs', type=int,
+                            help='number of files to hash in parallel (default: number '
+                            'of CPUs)')
 
     sub_parser = sub_parsers.add_parser('cat-file',
                                         help='display contents of object')
     valid_modes = ['commit', 'tree', 'blob', 'size', 'type', 'pretty']
-    sub_parser.add_argument('mode', choices=valid_modes,
+    sub_parser.add_argument('mode', choices=valid_modes, nargs='?',
                             help='object type (commit, tree, blob) or display mode (size, '
                             'type, pretty)')
-    sub_parser.add_argument('hash_prefix',
+    sub_parser.add_argument('hash_prefix', nargs='?',
                             help='SHA-1 hash (or hash prefix) of object to display')
+    batch_group = sub_parser.add_mutually_exclusive_group()
+    batch_group.add_argument('--batch', action='store_const', const='batch',
+                             dest='batch',
+                             help='print type, size and contents of each object named '
+                             'on stdin')
+    batch_group.add_argument('--batch-check', action='store_const',
+                             const='batch-check', dest='batch',
+                             help='print type and size of each object named on stdin')
 
     sub_parser = sub_parsers.add_parser('commit',
                                         help='commit current state of index to main branch')
@@ -507,12 +3316,30 @@ if __name__ == '__main__':
     sub_parser = sub_parsers.add_parser('diff',
                                         help='show diff of files changed (between index and working '
                                         'copy)')
+    sub_parser.add_argument('pathspecs', nargs='*', metavar='pathspec',
+                            help='limit to paths under these directories or matching '
+                            'these glob patterns')
+    sub_parser.add_argument('-j', '--jobs', type=int,
+                            help='number of files to hash in parallel (default: number '
+                            'of CPUs)')
+
+    sub_parser = sub_parsers.add_parser('fsmonitor',
+                                        help='run a daemon that watches the working copy for '
+                                        'changes, used by status when core.fsmonitor is set')
+    sub_parser.add_argument('action', choices=['start', 'stop', 'run'],
+                            help='start the daemon in the background, stop it, or run '
+                            'it in the foreground')
 
     sub_parser = sub_parsers.add_parser('hash-object',
                                         help='hash contents of given path (and optionally write to '
                                         'object store)')
-    sub_parser.add_argument('path',
+    sub_parser.add_argument('path', nargs='?',
                             help='path of file to hash')
+    sub_parser.add_argument('--stdin-paths', action='store_true',
+                            help='read paths to hash from stdin, one per line')
+    sub_parser.add_argument('-j', '--jobs', type=int,
+                            help='number of files to hash in parallel with '
+                            '--stdin-paths (default: number of CPUs)')
     sub_parser.add_argument('-t', choices=['commit', 'tree', 'blob'],
                             default='blob', dest='type',
                             help='type of object (default %(default)r)')
@@ -529,6 +3356,11 @@ if __name__ == '__main__':
     sub_parser.add_argument('-s', '--stage', action='store_true',
                             help='show object details (mode, hash, and stage number) in '
                             'addition to path')
+    sub_parser.add_argument('-z', action='store_true', dest='null_terminated',
+                            help='terminate lines with NUL instead of newline')
+    sub_parser.add_argument('pathspecs', nargs='*', metavar='pathspec',
+                            help='limit to paths under these directories or matching '
+                            'these glob patterns')
 
     sub_parser = sub_parsers.add_parser('push',
                                         help='push main branch to given git server URL')
@@ -540,33 +3372,136 @@ if __name__ == '__main__':
     sub_parser.add_argument('-u', '--username',
                             help='username to use for authentication (uses GIT_USERNAME '
                             'environment variable by default)')
+    sub_parser.add_argument('--window', type=int, default=DELTA_WINDOW,
+                            help='number of objects to consider as delta bases, 0 '
+                            'disables deltas (default %(default)r)')
+    sub_parser.add_argument('--depth', type=int, default=DELTA_DEPTH,
+                            help='maximum delta chain length (default %(default)r)')
+    sub_parser.add_argument('--window-memory', type=int,
+                            default=DELTA_WINDOW_MEMORY,
+                            help='maximum bytes of object data kept in the delta '
+                            'window, 0 for unlimited (default %(default)r)')
+
+    sub_parser = sub_parsers.add_parser('repack',
+                                        help='pack objects reachable from main into a single pack '
+                                        'and prune loose objects')
+    sub_parser.add_argument('--window', type=int, default=DELTA_WINDOW,
+                            help='number of objects to consider as delta bases, 0 '
+                            'disables deltas (default %(default)r)')
+    sub_parser.add_argument('--depth', type=int, default=DELTA_DEPTH,
+                            help='maximum delta chain length (default %(default)r)')
+    sub_parser.add_argument('--window-memory', type=int,
+                            default=DELTA_WINDOW_MEMORY,
+                            help='maximum bytes of object data kept in the delta '
+                            'window, 0 for unlimited (default %(default)r)')
+    sub_parser.add_argument('--grace', type=float,
+                            default=PRUNE_GRACE_PERIOD / (24 * 60 * 60),
+                            help='keep unreachable objects younger than this many '
+                            'days (default %(default)r)')
+    sub_parser.add_argument('--no-prune', action='store_false', dest='prune',
+                            help='keep loose objects and old packs')
+
+    sub_parser = sub_parsers.add_parser('update-index',
+                                        help='update stat data of index entries')
+    sub_parser.add_argument('--refresh', action='store_true', required=True,
+                            help='rewrite stale stat data of entries whose contents '
+                            'are unchanged')
 
     sub_parser = sub_parsers.add_parser('status',
                                         help='show status of working copy')
+    sub_parser.add_argument('-z', action='store_true', dest='null_terminated',
+                            help="print 'XY path' records terminated with NUL, like "
+                            'git status -z')
+    sub_parser.add_argument('pathspecs', nargs='*', metavar='pathspec',
+                            help='limit to paths under these directories or matching '
+                            'these glob patterns')
+    sub_parser.add_argument('-j', '--jobs', type=int,
+                            help='number of files to hash in parallel (default: number '
+                            'of CPUs)')
 
     args = parser.parse_args()
     if args.command == 'add':
-        add(args.paths)
+        if not args.paths and not args.all:
+            parser.error('nothing specified, nothing added')
+        try:
+            add(args.paths, all_files=args.all, jobs=args.jobs)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
     elif args.command == 'cat-file':
+        if args.batch and (args.mode or args.hash_prefix):
+            parser.error('--{} reads object names from stdin'.format(
+                args.batch))
+        elif not args.batch and not args.hash_prefix:
+            parser.error('cat-file requires a mode and a hash prefix')
         try:
-            cat_file(args.mode, args.hash_prefix)
+            if args.batch:
+                cat_file_batch(contents=args.batch == 'batch')
+            else:
+                cat_file(args.mode, args.hash_prefix)
         except ValueError as error:
             print(error, file=sys.stderr)
             sys.exit(1)
     elif args.command == 'commit':
         commit(args.message, author=args.author)
     elif args.command == 'diff':
-        diff()
+        diff(jobs=args.jobs, pathspecs=args.pathspecs)
+    elif args.command == 'fsmonitor':
+        try:
+            if args.action == 'start':
+                start_fsmonitor()
+            elif args.action == 'stop':
+                stop_fsmonitor()
+            else:
+                run_fsmonitor()
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
     elif args.command == 'hash-object':
-        sha1 = hash_object(read_file(args.path), args.type, write=args.write)
-        print(sha1)
+        if args.stdin_paths:
+            if args.path:
+                parser.error('--stdin-paths reads paths from stdin')
+            paths = (line.rstrip('\r\n') for line in sys.stdin)
+            for sha1 in hash_files(paths, args.type, write=args.write,
+                                   jobs=args.jobs):
+                sys.stdout.write(sha1 + '\n')
+        elif not args.path:
+            parser.error('hash-object requires a path or --stdin-paths')
+        else:
+            sha1 = hash_file(args.path, args.type, write=args.write)
+            print(sha1)
     elif args.command == 'init':
         init(args.repo)
     elif args.command == 'ls-files':
-        ls_files(details=args.stage)
+        try:
+            ls_files(details=args.stage, pathspecs=args.pathspecs,
+                     null_terminated=args.null_terminated)
+        except BrokenPipeError:
+            # the reader stopped early (e.g. head); keep the final flush quiet
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
     elif args.command == 'push':
-        push(args.git_url, username=args.username, password=args.password)
+        push(args.git_url, username=args.username, password=args.password,
+             window=args.window, depth=args.depth,
+             window_memory=args.window_memory)
+    elif args.command == 'repack':
+        try:
+            repack(window=args.window, depth=args.depth,
+                   window_memory=args.window_memory, prune=args.prune,
+                   grace=args.grace * 24 * 60 * 60)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            sys.exit(1)
     elif args.command == 'status':
-        status()
+        status(jobs=args.jobs, pathspecs=args.pathspecs,
+               null_terminated=args.null_terminated)
+    elif args.command == 'update-index':
+        refreshed, modified = refresh_index()
+        for path in modified:
+            print('{}: needs update'.format(path))
+        print('refreshed {} entr{}, {} modified'.format(
+            refreshed, 'y' if refreshed == 1 else 'ies', len(modified)))
+        if modified:
+            sys.exit(1)
     else:
         assert False, 'unexpected command {!r}'.format(args.command)
\ No newline at end of file